@@ -0,0 +1,317 @@
+import os
+import time
+import threading
+import logging
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from cache import CACHE_DIR, write_private_json, read_private_json
+
+# Default configuration values
+# Limits are enforced per worker process. Rates and bursts are configured for the
+# whole host and divided by ADMISSION_WORKERS (set to WEB_CONCURRENCY by
+# gunicorn.conf.py). ADMISSION_MAX_IN_FLIGHT is per worker and must stay below the
+# worker's thread count, otherwise requests never queue and fair queuing and
+# degraded mode never engage.
+ADMISSION_WORKERS = max(1, int(os.environ.get("ADMISSION_WORKERS", 1)))  # Worker processes sharing the limits
+ORG_RATE_PER_SEC = float(os.environ.get("ADMISSION_ORG_RATE_PER_SEC", 5.0))  # Token refill rate per organization
+ORG_BURST = float(os.environ.get("ADMISSION_ORG_BURST", 20))  # Token bucket capacity per organization
+USER_RATE_PER_SEC = float(os.environ.get("ADMISSION_USER_RATE_PER_SEC", 1.0))  # Token refill rate per user
+USER_BURST = float(os.environ.get("ADMISSION_USER_BURST", 5))  # Token bucket capacity per user
+MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 4))  # Concurrent Snowflake-bound requests
+MAX_QUEUE_DEPTH = int(os.environ.get("ADMISSION_MAX_QUEUE_DEPTH", 32))  # Requests allowed to wait for a slot
+QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 30))  # Seconds a request may wait before being shed
+DEGRADED_QUEUE_DEPTH = int(os.environ.get("ADMISSION_DEGRADED_QUEUE_DEPTH", 2))  # Queue depth that triggers degraded mode
+BUCKET_SWEEP_SECONDS = 60  # Interval between sweeps that drop idle rate-limit buckets
+LOAD_PUBLISH_SECONDS = 1.0  # Interval at which each worker shares its load with the other workers
+LOAD_STALE_SECONDS = 5.0  # Shared load older than this is ignored (e.g. the worker exited)
+LOAD_FILE_PREFIX = "admission-load."  # Per-worker load files in the private cache directory
+ORG_WEIGHTS = os.environ.get("ADMISSION_ORG_WEIGHTS", "")  # e.g. "org_a:2,org_b:0.5"
+ANONYMOUS_KEY = "anonymous"  # Prefix of the per-client key used for requests without an org_id
+
+
+def _parse_weights(weights_str):
+    """Parse 'org:weight' pairs into a dictionary"""
+    weights = {}
+    for pair in weights_str.split(','):
+        if ':' not in pair:
+            continue
+        org, weight = pair.rsplit(':', 1)
+        try:
+            weights[org.strip()] = max(float(weight), 0.01)
+        except ValueError:
+            logging.warning(f"Ignoring invalid admission weight: {pair}")
+    return weights
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed instead of being admitted"""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Simple token bucket; callers must hold the controller lock"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def seconds_until_available(self):
+        if self.rate <= 0:
+            return 60
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Ticket:
+    """Handle given to an admitted request"""
+
+    def __init__(self, org_key, degraded, queue_wait):
+        self.org_key = org_key
+        self.degraded = degraded
+        self.queue_wait = queue_wait
+
+
+class _Waiter:
+    def __init__(self, org_key, tag):
+        self.org_key = org_key
+        self.tag = tag
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    """
+    Per-organization admission control for Snowflake-bound requests.
+
+    Requests are rate limited by per-org and per-user token buckets, then
+    compete for a fixed number of in-flight slots. Waiting requests are
+    dispatched by weighted fair queuing across organizations so a single
+    org cannot monopolize the warehouse, and the queue is bounded.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_queue_depth=MAX_QUEUE_DEPTH,
+                 queue_timeout=QUEUE_TIMEOUT, degraded_queue_depth=DEGRADED_QUEUE_DEPTH,
+                 org_weights=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.queue_timeout = queue_timeout
+        self.degraded_queue_depth = degraded_queue_depth
+        self.org_weights = org_weights if org_weights is not None else _parse_weights(ORG_WEIGHTS)
+
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self._org_buckets = {}
+        self._user_buckets = {}
+        self._queues = defaultdict(deque)
+        self._last_finish = defaultdict(float)
+        self._virtual_time = 0.0
+        self._in_flight = 0
+        self._queued = 0
+
+        # Metrics
+        self._admitted = 0
+        self._degraded = 0
+        self._shed = defaultdict(int)
+        self._shed_by_org = defaultdict(int)
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._queue_wait_count = 0
+        self._publisher = None
+
+    def _bucket(self, buckets, key, rate, capacity):
+        bucket = buckets.get(key)
+        if bucket is None:
+            # Host-wide limits are split evenly across worker processes
+            bucket = TokenBucket(rate / ADMISSION_WORKERS, max(1.0, capacity / ADMISSION_WORKERS))
+            buckets[key] = bucket
+        return bucket
+
+    def _sweep_locked(self, now):
+        """Drop buckets that have refilled completely and fair-queuing state of idle orgs"""
+        if now - self._last_sweep < BUCKET_SWEEP_SECONDS:
+            return
+        self._last_sweep = now
+        for buckets in (self._org_buckets, self._user_buckets):
+            idle = [
+                key for key, bucket in buckets.items()
+                if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity
+            ]
+            for key in idle:
+                del buckets[key]
+        for org_key in [key for key, finish in self._last_finish.items() if key not in self._queues and finish <= self._virtual_time]:
+            del self._last_finish[org_key]
+
+    def _shed_locked(self, org_key, reason, retry_after):
+        self._shed[reason] += 1
+        self._shed_by_org[org_key] += 1
+        logging.warning(f"Shedding request for org {org_key}: {reason}")
+        return AdmissionRejected(reason, retry_after)
+
+    def is_overloaded(self):
+        """True when optional work should be skipped to relieve pressure"""
+        return self._queued >= self.degraded_queue_depth
+
+    def is_busy(self, threshold=0.5):
+        """True when live traffic holds at least `threshold` of the in-flight slots"""
+        return self._queued > 0 or self._in_flight >= self.max_in_flight * threshold
+
+    def start_load_publisher(self):
+        """With several workers, share this worker's load through the cache directory every second"""
+        if ADMISSION_WORKERS <= 1 or self._publisher is not None:
+            return
+        self._publisher = threading.Thread(target=self._publish_load_loop, name="admission-load", daemon=True)
+        self._publisher.start()
+
+    def _publish_load_loop(self):
+        load_file = f"{LOAD_FILE_PREFIX}{os.getpid()}.json"
+        while True:
+            try:
+                write_private_json(load_file, {
+                    "in_flight": self._in_flight,
+                    "queued": self._queued,
+                    "max_in_flight": self.max_in_flight,
+                    "updated": time.time()
+                })
+            except (OSError, RuntimeError) as e:
+                logging.warning(f"Could not share admission load: {e}")
+            time.sleep(LOAD_PUBLISH_SECONDS)
+
+    def host_load(self):
+        """Sum the load shared by all live workers on the host; None if no shared load is available"""
+        if ADMISSION_WORKERS <= 1:
+            return None
+        try:
+            names = [name for name in os.listdir(CACHE_DIR) if name.startswith(LOAD_FILE_PREFIX) and name.endswith(".json")]
+        except OSError:
+            return None
+        total = {"in_flight": 0, "queued": 0, "max_in_flight": 0, "workers": 0}
+        now = time.time()
+        for name in names:
+            load = read_private_json(name)
+            if not load or now - load.get("updated", 0) > LOAD_STALE_SECONDS:
+                continue
+            for key in ("in_flight", "queued", "max_in_flight"):
+                total[key] += load.get(key, 0)
+            total["workers"] += 1
+        return total if total["workers"] else None
+
+    def is_host_busy(self, threshold=0.5):
+        """Like is_busy(), across all workers on the host when they share their load"""
+        load = self.host_load()
+        if load is None:
+            return self.is_busy(threshold)
+        return load["queued"] > 0 or load["in_flight"] >= load["max_in_flight"] * threshold
+
+    def _acquire(self, org_id, user_id, client_key):
+        # Requests without an org are keyed per client so they do not share one bucket and queue
+        org_key = org_id or (f"{ANONYMOUS_KEY}:{client_key}" if client_key else ANONYMOUS_KEY)
+        now = time.monotonic()
+        with self._lock:
+            self._sweep_locked(now)
+            org_bucket = self._bucket(self._org_buckets, org_key, ORG_RATE_PER_SEC, ORG_BURST)
+            if not org_bucket.try_acquire(now):
+                raise self._shed_locked(org_key, "org_rate_limited", org_bucket.seconds_until_available())
+            if user_id:
+                user_bucket = self._bucket(self._user_buckets, (org_key, user_id), USER_RATE_PER_SEC, USER_BURST)
+                if not user_bucket.try_acquire(now):
+                    raise self._shed_locked(org_key, "user_rate_limited", user_bucket.seconds_until_available())
+
+            degraded = self.is_overloaded()
+            if self._in_flight < self.max_in_flight and self._queued == 0:
+                self._in_flight += 1
+                return org_key, degraded, None
+
+            if self._queued >= self.max_queue_depth:
+                raise self._shed_locked(org_key, "queue_full", 1)
+
+            # Start-time fair queuing: each org advances by 1/weight per request
+            weight = self.org_weights.get(org_key, 1.0)
+            tag = max(self._virtual_time, self._last_finish[org_key]) + 1.0 / weight
+            self._last_finish[org_key] = tag
+            waiter = _Waiter(org_key, tag)
+            self._queues[org_key].append(waiter)
+            self._queued += 1
+            degraded = degraded or self.is_overloaded()
+
+        if waiter.event.wait(self.queue_timeout):
+            return org_key, degraded, waiter
+
+        with self._lock:
+            if waiter.granted:
+                return org_key, degraded, waiter
+            self._queues[org_key].remove(waiter)
+            self._queued -= 1
+            raise self._shed_locked(org_key, "queue_timeout", 1)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            while self._in_flight < self.max_in_flight and self._queued > 0:
+                # Dispatch the waiter with the smallest virtual start tag
+                org_key = min(
+                    (key for key, queue in self._queues.items() if queue),
+                    key=lambda key: self._queues[key][0].tag
+                )
+                waiter = self._queues[org_key].popleft()
+                if not self._queues[org_key]:
+                    del self._queues[org_key]
+                self._queued -= 1
+                self._in_flight += 1
+                self._virtual_time = waiter.tag
+                waiter.granted = True
+                waiter.event.set()
+
+    @contextmanager
+    def admit(self, org_id=None, user_id=None, client_key=None):
+        """
+        Admit a request, blocking for a fair share slot; raises AdmissionRejected when shed.
+        client_key (e.g. the client address) identifies requests that carry no org_id.
+        """
+        start = time.monotonic()
+        org_key, degraded, _ = self._acquire(org_id, user_id, client_key)
+        queue_wait = time.monotonic() - start
+        with self._lock:
+            self._admitted += 1
+            if degraded:
+                self._degraded += 1
+            self._queue_wait_total += queue_wait
+            self._queue_wait_count += 1
+            self._queue_wait_max = max(self._queue_wait_max, queue_wait)
+        try:
+            yield Ticket(org_key, degraded, queue_wait)
+        finally:
+            self._release()
+
+    def get_stats(self):
+        """Return admission, queue wait and load-shedding statistics"""
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue_depth": self.max_queue_depth,
+                "overloaded": self.is_overloaded(),
+                "admitted": self._admitted,
+                "degraded": self._degraded,
+                "shed": dict(self._shed),
+                "shed_total": sum(self._shed.values()),
+                "shed_by_org": dict(self._shed_by_org),
+                "queue_wait": {
+                    "count": self._queue_wait_count,
+                    "avg_seconds": self._queue_wait_total / self._queue_wait_count if self._queue_wait_count else 0.0,
+                    "max_seconds": self._queue_wait_max
+                }
+            }
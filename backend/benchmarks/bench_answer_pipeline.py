@@ -0,0 +1,171 @@
+"""
+Compare the client-side answer pipeline with the single-round-trip server pipeline.
+
+Both paths run the real DocumentAssistant code against an in-process
+stand-in for Snowflake that charges a fixed network round trip per
+statement (BENCH_RTT_MS) plus a fixed completion time (BENCH_COMPLETE_MS).
+The server path uses LocalAnswerProcedure, so the whole pipeline costs one
+round trip plus the same completion time. Both paths see the same three
+stored turns of chat history and build the same prompt; the prompt size is
+reported so this can be checked. Each path is measured with a cold
+suggestion cache (the KB is scanned on every request) and a warm one.
+
+Usage: python benchmarks/bench_answer_pipeline.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from document_assistant import DocumentAssistant, CORTEX_SEARCH_DATABASE  # noqa: E402
+from cache import TTLCache  # noqa: E402
+from conversation_summary import ConversationSummarizer  # noqa: E402
+from server_pipeline import LocalAnswerProcedure  # noqa: E402
+from sql_profiler import ProfiledSession, profiler  # noqa: E402
+
+RTT = float(os.environ.get("BENCH_RTT_MS", 60)) / 1000
+COMPLETE_SECONDS = float(os.environ.get("BENCH_COMPLETE_MS", 500)) / 1000
+ITERATIONS = int(os.environ.get("BENCH_ITERATIONS", 10))
+
+SEARCH_ROWS = [
+    {"chunk": "Patient Jane Doe, UHID 1234, admitted with pneumonia. How to assign a bed to a patient?",
+     "relative_path": f"reports/report_{i}.pdf", "category": "DISCHARGE"}
+    for i in range(5)
+]
+KB_CHUNKS = [
+    "How do I register a new patient? Open the registration screen. Where are lab reports stored? In the lab module.",
+    "How is a discharge summary created? Use the discharge tab. Who approves a hospital bill? The billing desk."
+]
+HISTORY_ROWS = [
+    {"QUESTION": f"Earlier question {i}?", "ANSWER": "A long structured clinical answer. " * 40, "TIMESTAMP": None, "CATEGORY": "ALL"}
+    for i in range(3)
+]
+USER_ID = "doctor-1"
+ORG_ID = "org-1"
+prompt_sizes = []
+
+
+class FakeRow(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+class FakeDataFrame:
+    def __init__(self, query, params=None):
+        self.query = query.lower()
+        self.params = params
+
+    def collect(self, **kwargs):
+        time.sleep(RTT)
+        if "information_schema.tables" in self.query:
+            return [FakeRow(TABLE_EXISTS=1)]
+        if "cortex.complete" in self.query:
+            time.sleep(COMPLETE_SECONDS)
+            prompt_sizes.append(len(self.params[1]))
+            return [FakeRow(RESPONSE="The patient was admitted with pneumonia.")]
+        if "contains(chunk" in self.query:
+            return [FakeRow(CHUNK=chunk) for chunk in KB_CHUNKS]
+        if "select question, answer" in self.query:
+            return [FakeRow(row) for row in HISTORY_ROWS]
+        return []
+
+
+class FakeSession:
+    def sql(self, query, params=None):
+        return FakeDataFrame(query, params)
+
+
+class FakeSearchResponse:
+    results = SEARCH_ROWS
+
+
+class FakeSearchService:
+    def search(self, query, columns, filter=None, limit=5):
+        time.sleep(RTT)
+        return FakeSearchResponse()
+
+
+class BenchAnswerProcedure(LocalAnswerProcedure):
+    def __call__(self, **kwargs):
+        # One network round trip for the CALL itself; everything else runs server side
+        with profiler.track(f"CALL {CORTEX_SEARCH_DATABASE}.CHATDOC_ANSWER"):
+            time.sleep(RTT)
+            return super().__call__(**kwargs)
+
+
+def stored_history():
+    """The rows FakeSession returns, as history table rows oldest first"""
+    return [
+        {"user_id": USER_ID, "org_id": ORG_ID, "question": row["QUESTION"], "answer": row["ANSWER"]}
+        for row in reversed(HISTORY_ROWS)
+    ]
+
+
+def bench_complete(model_name, prompt):
+    time.sleep(COMPLETE_SECONDS)
+    prompt_sizes.append(len(prompt))
+    return "The patient was admitted with pneumonia."
+
+
+def make_assistant(server_pipeline):
+    assistant = DocumentAssistant.__new__(DocumentAssistant)
+    assistant.session = ProfiledSession(FakeSession(), profiler)
+    assistant.svc = FakeSearchService()
+    assistant.retrieval_cache = TTLCache("retrieval")
+    assistant.suggestion_cache = TTLCache("suggestions")
+    assistant.answer_cache = TTLCache("answers")
+    assistant.catalog_cache = TTLCache("catalog")
+    assistant.summarizer = ConversationSummarizer(assistant, enabled=False)
+    assistant.answer_procedure = None
+    if server_pipeline:
+        assistant.answer_procedure = BenchAnswerProcedure(
+            search=lambda query, category, limit: SEARCH_ROWS[:limit],
+            complete=bench_complete,
+            kb_chunks=KB_CHUNKS
+        )
+    return assistant
+
+
+def ask(assistant):
+    return assistant.get_answer("What was the patient admitted with?", user_id=USER_ID, org_id=ORG_ID)
+
+
+def run(server_pipeline, warm_suggestions):
+    assistant = make_assistant(server_pipeline)
+    if warm_suggestions:
+        ask(assistant)
+    latencies = []
+    round_trips = []
+    prompt_sizes.clear()
+    for i in range(ITERATIONS):
+        # Cold caches and the same stored history each iteration so both paths do the same work
+        caches = [assistant.retrieval_cache, assistant.answer_cache]
+        if not warm_suggestions:
+            caches.append(assistant.suggestion_cache)
+        for cache in caches:
+            cache.clear()
+        if server_pipeline:
+            assistant.answer_procedure.history_rows[:] = stored_history()
+        profiler.start_request(f"bench-{i}", "bench")
+        start = time.perf_counter()
+        result = ask(assistant)
+        latencies.append(time.perf_counter() - start)
+        round_trips.append(len(profiler.end_request().statements))
+        assert result["answer"] and result["suggested_questions"]
+    assistant.summarizer.shutdown()
+    return sum(latencies) / len(latencies) * 1000, sum(round_trips) / len(round_trips), sum(prompt_sizes) / len(prompt_sizes)
+
+
+def main():
+    print(f"rtt: {RTT * 1000:.0f} ms, completion: {COMPLETE_SECONDS * 1000:.0f} ms, iterations: {ITERATIONS}")
+    print(f"{'path':>8} {'suggestions':>12} {'avg ms':>10} {'round trips':>12} {'prompt chars':>13}")
+    for warm_suggestions in (False, True):
+        for name, server_pipeline in (("client", False), ("server", True)):
+            avg_ms, trips, prompt_chars = run(server_pipeline, warm_suggestions)
+            state = "warm" if warm_suggestions else "cold"
+            print(f"{name:>8} {state:>12} {avg_ms:>10.1f} {trips:>12.1f} {prompt_chars:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Compare the old JSON-string retrieval path with the typed RetrievalResult path.
+
+The old path serialized Cortex Search results to a JSON string, then parsed
+it again in create_prompt, _generate_questions_from_kb and /api/raw_context.
+The new path builds a RetrievalResult once and serializes it only at the
+HTTP edge.
+
+Usage: python benchmarks/bench_retrieval.py [num_chunks ...]
+"""
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from retrieval import RetrievalResult, dumps, orjson  # noqa: E402
+
+ITERATIONS = 200
+CHUNK_TEXT = "Patient presented with fever and cough. Chest X-ray showed consolidation. " * 20
+
+
+def make_rows(num_chunks):
+    return [
+        {"chunk": CHUNK_TEXT, "relative_path": f"reports/patient_{i}.pdf", "category": "DISCHARGE"}
+        for i in range(num_chunks)
+    ]
+
+
+def old_path(rows):
+    # get_similar_chunks: response.json()
+    raw = json.dumps({"results": rows})
+    # create_prompt: embed the string, then parse it for relative paths
+    prompt = f"<context>\n{raw}\n</context>"
+    parsed = json.loads(raw)
+    paths = set(item.get("relative_path", "") for item in parsed.get("results", []))
+    # _generate_questions_from_kb: parse again
+    parsed = json.loads(raw)
+    context_text = "".join(item.get("chunk", "") + "\n\n" for item in parsed.get("results", []))
+    # /api/raw_context: parse again and re-serialize with jsonify
+    body = json.dumps({"context": json.loads(raw)}).encode("utf-8")
+    return prompt, paths, context_text, body
+
+
+def new_path(rows):
+    result = RetrievalResult.from_rows(rows)
+    prompt = f"<context>\n{result.context_text()}\n</context>"
+    paths = result.relative_paths
+    context_text = "".join(item.chunk + "\n\n" for item in result.chunks if item.chunk)
+    body = dumps({"context": result.to_dict()})
+    return prompt, paths, context_text, body
+
+
+def measure(func, rows):
+    func(rows)
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func(rows)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / ITERATIONS
+
+    tracemalloc.start()
+    func(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed_ms, peak / 1024
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [5, 50, 500]
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}, iterations: {ITERATIONS}")
+    print(f"{'num_chunks':>10} {'old ms':>10} {'new ms':>10} {'old peak KiB':>14} {'new peak KiB':>14}")
+    for num_chunks in sizes:
+        rows = make_rows(num_chunks)
+        old_ms, old_kib = measure(old_path, rows)
+        new_ms, new_kib = measure(new_path, rows)
+        print(f"{num_chunks:>10} {old_ms:>10.3f} {new_ms:>10.3f} {old_kib:>14.1f} {new_kib:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
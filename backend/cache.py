@@ -0,0 +1,331 @@
+import os
+import re
+import json
+import stat
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Default configuration values
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 3600))  # Lifetime of cached entries
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 1000))  # Entries kept per cache before LRU eviction
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory").lower()  # "memory" (per process) or "sqlite" (shared by workers)
+# Private runtime directory (0700, owned by the service user) holding the shared cache file
+CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()),
+    f"chatdoc-cache-{os.geteuid()}"
+)
+CACHE_SQLITE_PATH = os.path.join(CACHE_DIR, "cache.sqlite")
+SQLITE_EVICTION_INTERVAL = 64  # Writes between eviction sweeps of a shared cache
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    """Normalize a question so trivially different phrasings share a cache key"""
+    if not question:
+        return ""
+    normalized = _WHITESPACE.sub(" ", question.strip().lower())
+    return normalized.rstrip("?.! ")
+
+
+def ensure_cache_dir():
+    """
+    Create the cache directory with mode 0700 and verify that it is a real
+    directory owned by this user and not accessible to anyone else, so other
+    local users cannot read the cache or plant a file for the app to load.
+    """
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    info = os.lstat(CACHE_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"Cache directory {CACHE_DIR} must be a directory owned by this user with mode 0700")
+    return CACHE_DIR
+
+
+def write_private_json(filename, payload):
+    """Atomically replace a JSON file in the private cache directory, readable by this user only"""
+    ensure_cache_dir()
+    path = os.path.join(CACHE_DIR, filename)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with os.fdopen(os.open(temp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC | os.O_NOFOLLOW, 0o600), "w") as f:
+        json.dump(payload, f)
+    os.replace(temp_path, path)
+    return path
+
+
+def read_private_json(filename):
+    """Return the contents of a JSON file written by write_private_json, or None"""
+    try:
+        with open(os.path.join(CACHE_DIR, filename)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {filename} from the cache directory: {e}")
+        return None
+
+
+def _encode(value):
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value)}
+    if hasattr(value, "to_dict") and hasattr(type(value), "from_dict"):
+        return {"__retrieval__": value.to_dict()}
+    raise TypeError(f"Cannot store {type(value).__name__} in the shared cache")
+
+
+def _decode(obj):
+    if "__set__" in obj:
+        return set(obj["__set__"])
+    if "__retrieval__" in obj:
+        from retrieval import RetrievalResult
+        return RetrievalResult.from_dict(obj["__retrieval__"])
+    return obj
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a fixed time"""
+
+    def __init__(self, name, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def compare_and_set(self, key, expected, value, ttl_seconds=None):
+        """Store value only if the live entry still equals expected (None: missing or expired)"""
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry[1] if entry is not None and entry[0] >= time.monotonic() else None
+            if current != expected:
+                return False
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "backend": "memory",
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class SqliteCache:
+    """
+    TTL cache stored in a SQLite file so that all worker processes on the
+    host share entries. Each thread of each process opens its own
+    connection; cache errors are logged and treated as misses. Values are
+    stored as JSON (tuples come back as lists), never pickled.
+    """
+
+    def __init__(self, name, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, path=CACHE_SQLITE_PATH):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        ensure_cache_dir()
+        # Create the database file owner-only before SQLite opens it
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR | os.O_NOFOLLOW, 0o600))
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            )
+        """)
+
+    def _connect(self):
+        # Connections must not be shared across threads or inherited through fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Return the cached value or None if missing or expired"""
+        try:
+            row = self._connect().execute(
+                "SELECT value, expires_at FROM cache_entries WHERE name = ? AND key = ?",
+                (self.name, repr(key))
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Shared cache {self.name} read failed: {e}")
+            row = None
+        if row is None or row[1] < time.time():
+            self._count(False)
+            return None
+        self._count(True)
+        try:
+            return json.loads(row[0], object_hook=_decode)
+        except ValueError as e:
+            logging.warning(f"Shared cache {self.name} held an unreadable entry: {e}")
+            return None
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (name, key, expires_at, value) VALUES (?, ?, ?, ?)",
+                (self.name, repr(key), time.time() + ttl, json.dumps(value, default=_encode))
+            )
+            with self._stats_lock:
+                self._writes += 1
+                evict = self._writes % SQLITE_EVICTION_INTERVAL == 0
+            if evict:
+                self._evict(conn)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.warning(f"Shared cache {self.name} write failed: {e}")
+
+    def compare_and_set(self, key, expected, value, ttl_seconds=None):
+        """
+        Store value only if the live entry still equals expected (None: missing
+        or expired), atomically across every worker sharing the file.
+        expected must be a value previously returned by get().
+        """
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        now = time.time()
+        try:
+            encoded = json.dumps(value, default=_encode)
+            if expected is None:
+                cursor = self._connect().execute("""
+                    INSERT INTO cache_entries (name, key, expires_at, value) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (name, key) DO UPDATE SET expires_at = excluded.expires_at, value = excluded.value
+                    WHERE cache_entries.expires_at < ?
+                """, (self.name, repr(key), now + ttl, encoded, now))
+            else:
+                cursor = self._connect().execute("""
+                    UPDATE cache_entries SET expires_at = ?, value = ?
+                    WHERE name = ? AND key = ? AND value = ? AND expires_at >= ?
+                """, (now + ttl, encoded, self.name, repr(key), json.dumps(expected, default=_encode), now))
+            return cursor.rowcount == 1
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.warning(f"Shared cache {self.name} write failed: {e}")
+            return False
+
+    def _evict(self, conn):
+        """Drop expired entries, then the soonest-expiring ones beyond max_entries"""
+        conn.execute("DELETE FROM cache_entries WHERE name = ? AND expires_at < ?", (self.name, time.time()))
+        conn.execute("""
+            DELETE FROM cache_entries WHERE name = ? AND key IN (
+                SELECT key FROM cache_entries WHERE name = ?
+                ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.name, self.name, self.max_entries))
+
+    def __contains__(self, key):
+        try:
+            row = self._connect().execute(
+                "SELECT 1 FROM cache_entries WHERE name = ? AND key = ? AND expires_at >= ?",
+                (self.name, repr(key), time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None
+
+    def delete(self, key):
+        try:
+            self._connect().execute("DELETE FROM cache_entries WHERE name = ? AND key = ?", (self.name, repr(key)))
+        except sqlite3.Error as e:
+            logging.warning(f"Shared cache {self.name} delete failed: {e}")
+
+    def clear(self):
+        """Clear the cache for every worker sharing the file"""
+        try:
+            self._connect().execute("DELETE FROM cache_entries WHERE name = ?", (self.name,))
+        except sqlite3.Error as e:
+            logging.warning(f"Shared cache {self.name} clear failed: {e}")
+
+    def get_stats(self):
+        try:
+            entries = self._connect().execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE name = ?", (self.name,)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            entries = None
+        with self._stats_lock:
+            return {
+                "name": self.name,
+                "backend": "sqlite",
+                "pid": os.getpid(),
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def make_cache(name, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+    """Create a cache using the configured backend"""
+    if CACHE_BACKEND == "sqlite":
+        try:
+            return SqliteCache(name, ttl_seconds, max_entries)
+        except (OSError, RuntimeError, sqlite3.Error) as e:
+            logging.error(f"Shared cache unavailable, using a per-process cache for {name}: {e}")
+    return TTLCache(name, ttl_seconds, max_entries)
@@ -0,0 +1,154 @@
+import os
+import time
+import fcntl
+import threading
+import logging
+from document_assistant import CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CHAT_HISTORY_TABLE, DEFAULT_MODEL
+from cache import CACHE_BACKEND, CACHE_SQLITE_PATH, ensure_cache_dir
+
+# Default configuration values
+WARMER_ENABLED = os.environ.get("CACHE_WARMER_ENABLED", "true").lower() == "true"
+WARMER_INTERVAL_SECONDS = int(os.environ.get("CACHE_WARMER_INTERVAL_SECONDS", 1800))  # Time between warming runs
+WARMER_TOP_N = int(os.environ.get("CACHE_WARMER_TOP_N", 10))  # Most frequent questions warmed per category
+WARMER_LOOKBACK_DAYS = int(os.environ.get("CACHE_WARMER_LOOKBACK_DAYS", 14))  # History window mined for popularity
+WARMER_CREDIT_BUDGET = int(os.environ.get("CACHE_WARMER_CREDIT_BUDGET", 100))  # Cost units spent per run
+WARMER_PAUSE_SECONDS = float(os.environ.get("CACHE_WARMER_PAUSE_SECONDS", 5))  # Back-off while live load is high
+WARMER_MAX_PAUSE_SECONDS = float(os.environ.get("CACHE_WARMER_MAX_PAUSE_SECONDS", 300))  # Give up a run after this much waiting
+
+# Relative warehouse cost of each warming stage, in budget units
+RETRIEVAL_COST = 1
+SUGGESTION_COST = 1
+ANSWER_COST = 10
+
+
+class CacheWarmer:
+    """
+    Background thread that pre-populates the DocumentAssistant caches with
+    the most frequently asked questions from chat history, so the first
+    user after a deploy or cache expiry does not pay for the full pipeline.
+    """
+
+    def __init__(self, assistant, admission=None, interval_seconds=WARMER_INTERVAL_SECONDS,
+                 top_n=WARMER_TOP_N, credit_budget=WARMER_CREDIT_BUDGET):
+        self.assistant = assistant
+        self.admission = admission
+        self.interval_seconds = interval_seconds
+        self.top_n = top_n
+        self.credit_budget = credit_budget
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader_lock = None
+        self.last_run = None
+
+    def _acquire_leader(self):
+        """With a shared cache only one worker process on the host needs to warm it"""
+        if CACHE_BACKEND != "sqlite":
+            return True
+        try:
+            ensure_cache_dir()
+        except (OSError, RuntimeError) as e:
+            # Caches fell back to per-process memory, so every worker warms its own
+            logging.error(f"Shared cache directory unavailable: {e}")
+            return True
+        lock_file = os.fdopen(os.open(CACHE_SQLITE_PATH + ".warmer.lock", os.O_CREAT | os.O_RDWR | os.O_NOFOLLOW, 0o600), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Held for the life of the process; released by the OS when the worker exits
+        self._leader_lock = lock_file
+        return True
+
+    def start(self):
+        """Warm once immediately, then on a fixed schedule"""
+        if self._thread and self._thread.is_alive():
+            return
+        if not self._acquire_leader():
+            logging.info("Another worker is warming the shared cache, not starting warmer")
+            return
+        self._thread = threading.Thread(target=self._loop, name="cache-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.exception(f"Error warming caches: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def get_popular_questions(self):
+        """Return the top-N most frequent questions per category from chat history"""
+        # Grouped by the same normalization as cache.normalize_question, so each candidate is one cache key
+        query = f"""
+        SELECT category, question, question_count
+        FROM (
+            SELECT category,
+                   RTRIM(TRIM(REGEXP_REPLACE(LOWER(question), '\\\\s+', ' ')), '?.! ') AS normalized_question,
+                   ANY_VALUE(question) AS question,
+                   COUNT(*) AS question_count
+            FROM {CORTEX_SEARCH_DATABASE}.{CORTEX_SEARCH_SCHEMA}.{CHAT_HISTORY_TABLE}
+            WHERE timestamp >= DATEADD(day, -?, CURRENT_TIMESTAMP())
+            GROUP BY category, normalized_question
+        )
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY category ORDER BY question_count DESC) <= ?
+        ORDER BY question_count DESC
+        """
+        rows = self.assistant.session.sql(query, params=[WARMER_LOOKBACK_DAYS, self.top_n]).collect()
+        return [(row.CATEGORY or "ALL", row.QUESTION) for row in rows if row.QUESTION]
+
+    def _wait_for_capacity(self):
+        """Pause while live traffic on the host is high; returns False if the run should be abandoned"""
+        waited = 0.0
+        # The warmer runs in one worker, so it needs the load of every worker, not just its own
+        while self.admission is not None and self.admission.is_host_busy():
+            if self._stop.is_set() or waited >= WARMER_MAX_PAUSE_SECONDS:
+                return False
+            time.sleep(WARMER_PAUSE_SECONDS)
+            waited += WARMER_PAUSE_SECONDS
+        return not self._stop.is_set()
+
+    def run_once(self):
+        """Run a single warming pass within the credit budget"""
+        if not self._wait_for_capacity():
+            logging.info("Cache warming skipped due to live load")
+            return {"warmed": 0, "spent": 0}
+        if not self.assistant._ensure_chat_history_table_exists():
+            return {"warmed": 0, "spent": 0}
+
+        popular = self.get_popular_questions()
+        spent = 0
+        warmed = 0
+        warmed_categories = set()
+        for category, question in popular:
+            if not self._wait_for_capacity():
+                logging.info("Cache warming paused too long under live load, stopping this run")
+                break
+
+            answer_allowed = self.assistant.answer_cache_allowed(category)
+            cost = RETRIEVAL_COST
+            if category not in warmed_categories:
+                cost += SUGGESTION_COST
+            if answer_allowed:
+                cost += ANSWER_COST
+            if spent + cost > self.credit_budget:
+                logging.info(f"Cache warming budget of {self.credit_budget} reached")
+                break
+
+            if answer_allowed:
+                # get_answer fills the retrieval, answer and suggestion caches together
+                self.assistant.get_answer(question, model_name=DEFAULT_MODEL, category=category)
+            else:
+                self.assistant.get_similar_chunks(question, category)
+                self.assistant.get_suggested_questions_from_kb(question, category)
+            warmed_categories.add(category)
+            spent += cost
+            warmed += 1
+
+        self.last_run = {"warmed": warmed, "spent": spent, "candidates": len(popular), "finished_at": time.time()}
+        logging.info(f"Cache warming warmed {warmed}/{len(popular)} questions using {spent} budget units")
+        return self.last_run
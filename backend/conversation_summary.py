@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from cache import make_cache
+
+# Default configuration values
+ROLLING_SUMMARY_ENABLED = os.environ.get("ROLLING_SUMMARY_ENABLED", "true").lower() == "true"
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "llama3.1-8b")  # Small model used to compact older turns
+SUMMARY_MAX_WORDS = int(os.environ.get("SUMMARY_MAX_WORDS", 120))  # Target length of a rolling summary
+SUMMARY_BOOTSTRAP_TURNS = int(os.environ.get("SUMMARY_BOOTSTRAP_TURNS", 6))  # Turns read when no summary is cached
+SUMMARY_TTL_SECONDS = int(os.environ.get("SUMMARY_TTL_SECONDS", 24 * 3600))  # Lifetime of a cached summary
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", 2))  # Background threads generating summaries
+SUMMARY_WRITE_ATTEMPTS = 3  # Compare-and-set retries when another worker updates the same summary
+SUMMARY_BOOTSTRAP_TIMEOUT = 60  # Seconds a bootstrap claim is honoured before another worker may take over
+SUMMARY_BOOTSTRAP_POLL_SECONDS = 0.5  # Interval at which a refresh checks on another worker's bootstrap
+BASELINE_TURNS = 3  # Full Q/A pairs the prompt carried before rolling summaries
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token) used for reporting"""
+    return len(text or "") // 4
+
+
+def _turn(row):
+    return {"question": row["question"], "answer": row["answer"]}
+
+
+def _format_turn(turn):
+    return f"Q: {turn['question']}\nA: {turn['answer']}"
+
+
+class ConversationSummarizer:
+    """
+    Keeps a rolling summary of each user's older turns so prompts carry a
+    short summary plus only the latest Q/A pair instead of several full
+    answers. Summaries are refreshed asynchronously after each stored turn
+    by folding the previous latest turn into the existing summary. Each
+    entry records the time of the newest turn it covers ("folded_at") and is
+    written with compare-and-set, so refreshes racing in other threads or
+    worker processes cannot roll it back to an older turn. Only one bootstrap
+    per user runs at a time: it is claimed in-process and with a short-lived
+    compare-and-set entry in the shared cache.
+    When disabled, only completion latency is recorded as a baseline.
+    """
+
+    def __init__(self, assistant, enabled=ROLLING_SUMMARY_ENABLED):
+        self.assistant = assistant
+        self.enabled = enabled
+        self.cache = make_cache("summaries", ttl_seconds=SUMMARY_TTL_SECONDS)
+        self._executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summarizer")
+        self._stats_lock = threading.Lock()
+        self._bootstrapping = set()
+        self._stats = {
+            "summaries_generated": 0,
+            "summary_errors": 0,
+            "prompts": 0,
+            "baseline_tokens": 0,
+            "history_tokens": 0
+        }
+        self._latency = defaultdict(lambda: {"count": 0, "total_seconds": 0.0})
+
+    def _key(self, user_id, org_id):
+        return (user_id, org_id or "")
+
+    def _summarize(self, summary, turns):
+        """Fold new turns into an existing summary using Cortex complete"""
+        prompt = f"""
+        You maintain a running summary of a clinician's conversation with a medical records assistant.
+        Update the summary with the new exchanges below. Keep patient names/IDs, diagnoses, key findings
+        and open questions. Use at most {SUMMARY_MAX_WORDS} words and do not add information that is not present.
+
+        Current summary:
+        {summary or "(none)"}
+
+        New exchanges:
+        {chr(10).join(_format_turn(turn) for turn in turns)}
+
+        Updated summary:
+        """
+        cmd = """
+            select snowflake.cortex.complete(?, ?) as response
+        """
+        df_response = self.assistant.session.sql(cmd, params=[SUMMARY_MODEL, prompt]).collect()
+        return df_response[0].RESPONSE.strip()
+
+    def schedule(self, user_id, org_id, question, answer):
+        """Queue a summary refresh for a newly stored turn"""
+        if not user_id or not self.enabled:
+            return
+        # The turn is already stored, so any bootstrap reading history after this time includes it
+        turn_at = time.time()
+        self._executor.submit(self._refresh, user_id, org_id, {"question": question, "answer": answer}, turn_at)
+
+    def _claim_key(self, key):
+        return ("bootstrap",) + key
+
+    def _bootstrap_pending(self, key):
+        with self._stats_lock:
+            if key in self._bootstrapping:
+                return True
+        return self._claim_key(key) in self.cache
+
+    def _claim_bootstrap(self, key):
+        """Claim the bootstrap of a user's summary for this thread; False if one is already running"""
+        with self._stats_lock:
+            if key in self._bootstrapping:
+                return False
+            self._bootstrapping.add(key)
+        if self.cache.compare_and_set(self._claim_key(key), None, os.getpid(), ttl_seconds=SUMMARY_BOOTSTRAP_TIMEOUT):
+            return True
+        with self._stats_lock:
+            self._bootstrapping.discard(key)
+        return False
+
+    def _release_bootstrap(self, key):
+        self.cache.delete(self._claim_key(key))
+        with self._stats_lock:
+            self._bootstrapping.discard(key)
+
+    def _wait_for_bootstrap(self, key):
+        """Wait for a bootstrap running elsewhere; False if it is still unfinished after the timeout"""
+        deadline = time.monotonic() + SUMMARY_BOOTSTRAP_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(SUMMARY_BOOTSTRAP_POLL_SECONDS)
+            if not self._bootstrap_pending(key) or self.cache.get(key) is not None:
+                return True
+        return False
+
+    def _bootstrap(self, user_id, org_id):
+        """Build an entry from stored history; its latest turn is whatever the table holds newest"""
+        read_at = time.time()
+        history = self.assistant.get_recent_chat_history(user_id, org_id, limit=SUMMARY_BOOTSTRAP_TURNS)
+        if not history:
+            return None
+        older = [_turn(row) for row in history[1:]][::-1]
+        return {
+            "summary": self._summarize("", older) if older else "",
+            "latest": _turn(history[0]),
+            "folded_at": read_at,
+            "recent_tokens": [estimate_tokens(_format_turn(row)) for row in history[:BASELINE_TURNS]]
+        }
+
+    def _refresh(self, user_id, org_id, new_turn=None, turn_at=None):
+        """Fold new_turn into the user's summary, or only bootstrap the summary when no turn is given"""
+        key = self._key(user_id, org_id)
+        try:
+            for _ in range(SUMMARY_WRITE_ATTEMPTS):
+                entry = self.cache.get(key)
+                if entry is None:
+                    if self._claim_bootstrap(key):
+                        try:
+                            # The bootstrap reads history after new_turn was stored, so it covers that turn too
+                            updated = self._bootstrap(user_id, org_id)
+                            if updated is None:
+                                return
+                            if self.cache.compare_and_set(key, None, updated):
+                                with self._stats_lock:
+                                    self._stats["summaries_generated"] += 1
+                                return
+                        finally:
+                            self._release_bootstrap(key)
+                        continue
+                    # Another thread or worker is bootstrapping; fold new_turn in once its entry lands
+                    if new_turn is None or not self._wait_for_bootstrap(key):
+                        return
+                    continue
+                if new_turn is None or turn_at <= entry["folded_at"]:
+                    # Already covered by this entry, or superseded by a newer turn
+                    return
+                elif entry["latest"] == new_turn:
+                    # A bootstrap that ran after the turn was stored already made it the latest
+                    updated = dict(entry, folded_at=turn_at)
+                else:
+                    previous = entry["latest"]
+                    updated = {
+                        "summary": self._summarize(entry["summary"], [previous]) if previous else entry["summary"],
+                        "latest": new_turn,
+                        "folded_at": turn_at,
+                        "recent_tokens": ([estimate_tokens(_format_turn(new_turn))] + entry["recent_tokens"])[:BASELINE_TURNS]
+                    }
+                if self.cache.compare_and_set(key, entry, updated):
+                    with self._stats_lock:
+                        self._stats["summaries_generated"] += 1
+                    return
+            logging.warning(f"Gave up refreshing conversation summary for {key} after concurrent updates")
+        except Exception as e:
+            logging.exception(f"Error refreshing conversation summary: {e}")
+            with self._stats_lock:
+                self._stats["summary_errors"] += 1
+
+    def build_history_context(self, user_id, org_id=None, fetch_on_miss=True):
+        """Return the prompt history block: rolling summary plus the latest turn (None on a miss without fetch_on_miss)"""
+        entry = self.cache.get(self._key(user_id, org_id))
+        if entry is None and not fetch_on_miss:
+            return None
+        if entry is None:
+            # No summary yet: carry only the latest turn while one is built in the background
+            history = self.assistant.get_recent_chat_history(user_id, org_id, limit=1)
+            if not history:
+                return ""
+            latest = _turn(history[0])
+            # Bootstrap only, unless one is already running: the background read decides which turn is latest
+            if not self._bootstrap_pending(self._key(user_id, org_id)):
+                self._executor.submit(self._refresh, user_id, org_id)
+            summary = ""
+            baseline_tokens = None
+        else:
+            latest = entry["latest"]
+            summary = entry["summary"]
+            baseline_tokens = sum(entry["recent_tokens"])
+
+        context = ""
+        if summary:
+            context += f"\nSummary of earlier interactions:\n{summary}\n"
+        if latest:
+            context += f"\nMost recent interaction:\nQ1: {latest['question']}\nA1: {latest['answer']}\n\n"
+
+        if baseline_tokens is not None:
+            with self._stats_lock:
+                self._stats["prompts"] += 1
+                self._stats["baseline_tokens"] += baseline_tokens
+                self._stats["history_tokens"] += estimate_tokens(context)
+        return context
+
+    def record_completion(self, mode, seconds):
+        """Record completion latency by mode ('summary', 'full', 'none' or 'server_pipeline')"""
+        with self._stats_lock:
+            self._latency[mode]["count"] += 1
+            self._latency[mode]["total_seconds"] += seconds
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["enabled"] = self.enabled
+            stats["tokens_saved"] = stats["baseline_tokens"] - stats["history_tokens"]
+            stats["completion_latency"] = {
+                mode: {
+                    "count": values["count"],
+                    "avg_seconds": values["total_seconds"] / values["count"] if values["count"] else 0.0
+                }
+                for mode, values in self._latency.items()
+            }
+        stats["cache"] = self.cache.get_stats()
+        return stats
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
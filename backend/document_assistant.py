@@ -1,11 +1,18 @@
 import os
 import json
+import time
 import pandas as pd
 from datetime import datetime
 from snowflake.core import Root
 from snowflake.snowpark import Session
 from snowflake.snowpark.exceptions import SnowparkSQLException # ADDED THIS LINE
 import logging # ADDED THIS LINE
+from cache import make_cache, normalize_question
+from sql_profiler import ProfiledSession, profiler
+from retrieval import RetrievalResult
+import events
+from conversation_summary import ConversationSummarizer, ROLLING_SUMMARY_ENABLED, BASELINE_TURNS
+from server_pipeline import SnowflakeAnswerProcedure, CONTEXT_PLACEHOLDER, HISTORY_PLACEHOLDER
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s') # ADDED THIS LINE
@@ -18,6 +25,11 @@ CORTEX_SEARCH_SERVICE = "KK_SEARCH_SERVICE_CS"
 DEFAULT_MODEL = "llama3.3-70b"
 MIN_SUGGESTED_QUESTIONS = 4  # Minimum number of suggested questions
 CHAT_HISTORY_TABLE = "CHAT_HISTORY"  # Table to store chat history
+CATALOG_CACHE_TTL_SECONDS = 300  # Lifetime of cached document and category listings
+# "client" issues each pipeline step as its own statement, "server" answers with a single procedure CALL
+ANSWER_PIPELINE_MODE = os.environ.get("ANSWER_PIPELINE_MODE", "client").lower()
+# Categories whose answers do not depend on the user and may be served from cache ("*" for all)
+ANSWER_CACHE_CATEGORIES = [c.strip() for c in os.environ.get("ANSWER_CACHE_CATEGORIES", "").split(',') if c.strip()]
 
 # Columns to query in the service
 COLUMNS = [
@@ -26,21 +38,25 @@ COLUMNS = [
     "category"
 ]
 
+def create_session():
+    """Create a Snowflake session; parameters are read at call time to ensure .env is loaded"""
+    CONNECTION_PARAMETERS = {
+        "account": os.environ.get("SNOWFLAKE_ACCOUNT"),
+        "user": os.environ.get("SNOWFLAKE_USER"),
+        "password": os.environ.get("SNOWFLAKE_PASSWORD"),
+        "role": os.environ.get("SNOWFLAKE_ROLE"),
+        "database": os.environ.get("SNOWFLAKE_DATABASE"),
+        "warehouse": os.environ.get("SNOWFLAKE_WAREHOUSE"),
+        "schema": os.environ.get("SNOWFLAKE_SCHEMA"),
+    }
+    return Session.builder.configs(CONNECTION_PARAMETERS).create()
+
 class DocumentAssistant:
     def __init__(self):
-        # Define CONNECTION_PARAMETERS INSIDE __init__ to ensure .env is loaded
-        CONNECTION_PARAMETERS = {
-            "account": os.environ.get("SNOWFLAKE_ACCOUNT"),
-            "user": os.environ.get("SNOWFLAKE_USER"),
-            "password": os.environ.get("SNOWFLAKE_PASSWORD"),
-            "role": os.environ.get("SNOWFLAKE_ROLE"),
-            "database": os.environ.get("SNOWFLAKE_DATABASE"),
-            "warehouse": os.environ.get("SNOWFLAKE_WAREHOUSE"),
-            "schema": os.environ.get("SNOWFLAKE_SCHEMA"),
-        }
-        # Initialize Snowflake session
-        self.session = Session.builder.configs(CONNECTION_PARAMETERS).create()
-        self.root = Root(self.session)
+        # Initialize Snowflake session; statements are profiled per request
+        raw_session = create_session()
+        self.session = ProfiledSession(raw_session, profiler)
+        self.root = Root(raw_session)
 
         # Set up Cortex search service
         try:
@@ -50,6 +66,29 @@ class DocumentAssistant:
             logging.exception(f"Error connecting to search service: {e}")
             self.svc = None
 
+        # Caches for retrieval results, suggested questions and (policy permitting) answers
+        self.retrieval_cache = make_cache("retrieval")
+        self.suggestion_cache = make_cache("suggestions")
+        self.answer_cache = make_cache("answers")
+        self.catalog_cache = make_cache("catalog", ttl_seconds=CATALOG_CACHE_TTL_SECONDS)
+
+        # Rolling per-user conversation summaries keep prompt history short
+        self.summarizer = ConversationSummarizer(self, enabled=ROLLING_SUMMARY_ENABLED)
+
+        # Optional single-round-trip answer pipeline, installed up front to keep it off the request path
+        self.answer_procedure = None
+        if ANSWER_PIPELINE_MODE == "server":
+            self.answer_procedure = SnowflakeAnswerProcedure(
+                lambda: self.session, CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, CORTEX_SEARCH_SERVICE, CHAT_HISTORY_TABLE
+            )
+            try:
+                self.answer_procedure.install()
+            except Exception as e:
+                logging.exception(f"Error installing answer procedure, it will be retried on first use: {e}")
+
+        # Drop cached content whenever ingestion changes the document stage
+        events.subscribe(events.STAGE_CHANGED, self._on_stage_changed)
+
         # Set up pandas display options
         pd.set_option("max_colwidth", None)
 
@@ -57,18 +96,9 @@ class DocumentAssistant:
         """Re-establishes the Snowflake session and Cortex Search Service connection."""
         logging.info("Re-initializing Snowflake session and Cortex Search Service due to expired token.")
         try:
-            # Define CONNECTION_PARAMETERS INSIDE this method to ensure it's fresh
-            CONNECTION_PARAMETERS = {
-                "account": os.environ.get("SNOWFLAKE_ACCOUNT"),
-                "user": os.environ.get("SNOWFLAKE_USER"),
-                "password": os.environ.get("SNOWFLAKE_PASSWORD"),
-                "role": os.environ.get("SNOWFLAKE_ROLE"),
-                "database": os.environ.get("SNOWFLAKE_DATABASE"),
-                "warehouse": os.environ.get("SNOWFLAKE_WAREHOUSE"),
-                "schema": os.environ.get("SNOWFLAKE_SCHEMA"),
-            }
-            self.session = Session.builder.configs(CONNECTION_PARAMETERS).create()
-            self.root = Root(self.session)
+            raw_session = create_session()
+            self.session = ProfiledSession(raw_session, profiler)
+            self.root = Root(raw_session)
             self.svc = self.root.databases[CORTEX_SEARCH_DATABASE].schemas[CORTEX_SEARCH_SCHEMA].cortex_search_services[CORTEX_SEARCH_SERVICE]
             logging.info("Successfully re-initialized session and search service.")
             return True
@@ -99,11 +129,22 @@ class DocumentAssistant:
             logging.exception(f"Error checking chat history table: {e}")
             return False
 
+    def _on_stage_changed(self, payload):
+        """Invalidate caches derived from the document stage"""
+        logging.info(f"Document stage changed, clearing caches: {payload}")
+        for cache in (self.catalog_cache, self.retrieval_cache, self.suggestion_cache, self.answer_cache):
+            cache.clear()
+
     def get_available_documents(self):
         """Returns a list of available documents in the document store"""
+        cached = self.catalog_cache.get("documents")
+        if cached is not None:
+            return list(cached)
+
         try:
             docs_available = self.session.sql("ls @docs").collect()
             list_docs = [doc["name"] for doc in docs_available]
+            self.catalog_cache.set("documents", list_docs)
             return list_docs
         except Exception as e:
             logging.exception(f"Error retrieving documents: {e}")
@@ -111,59 +152,72 @@ class DocumentAssistant:
 
     def get_available_categories(self):
         """Returns a list of available document categories"""
+        cached = self.catalog_cache.get("categories")
+        if cached is not None:
+            return list(cached)
+
         try:
             categories = self.session.sql("select category from docs_chunks_table group by category").collect()
             cat_list = ['ALL']
             for cat in categories:
                 cat_list.append(cat.CATEGORY)
+            self.catalog_cache.set("categories", cat_list)
             return cat_list
         except Exception as e:
             logging.exception(f"Error retrieving categories: {e}")
             return ['ALL']
 
     def get_similar_chunks(self, query, category="ALL", num_chunks=NUM_CHUNKS):
-        """Retrieves similar chunks from the document corpus using Cortex Search Service"""
+        """Retrieves similar chunks from the document corpus using Cortex Search Service as a RetrievalResult"""
         if not self.svc:
             logging.error("Search service not available, cannot retrieve chunks.")
-            return json.dumps({"error": "Search service not available", "results": []})
+            return RetrievalResult.from_error("Search service not available")
+
+        cache_key = (normalize_question(query), category, num_chunks)
+        cached = self.retrieval_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
         try:
-            if category == "ALL":
-                response = self.svc.search(query, COLUMNS, limit=num_chunks)
-            else:
-                filter_obj = {"@eq": {"category": category}}
-                response = self.svc.search(query, COLUMNS, filter=filter_obj, limit=num_chunks)
+            with profiler.track("CORTEX_SEARCH " + CORTEX_SEARCH_SERVICE):
+                if category == "ALL":
+                    response = self.svc.search(query, COLUMNS, limit=num_chunks)
+                else:
+                    filter_obj = {"@eq": {"category": category}}
+                    response = self.svc.search(query, COLUMNS, filter=filter_obj, limit=num_chunks)
 
-            return response.json()
+            result = RetrievalResult.from_rows(response.results)
+            self.retrieval_cache.set(cache_key, result)
+            return result
         except Exception as e:
             logging.exception(f"Error retrieving similar chunks: {e}")
-            return json.dumps({"error": str(e), "results": []})
-
-    def create_prompt(self, question, use_rag=True, category="ALL", user_id=None, org_id=None):
-        """Creates a prompt for Cortex complete API with or without RAG context"""
-        if use_rag:
-            try:
-                prompt_context = self.get_similar_chunks(question, category)
-
-                # Include user_id and org_id in the prompt if provided
-                user_context = ""
-                if user_id or org_id:
-                    user_context = f"""
-                    Additional context:
-                    User ID: {user_id if user_id else 'Not provided'}
-                    Organization ID: {org_id if org_id else 'Not provided'}
-                    """
-
-                # Include previous interaction context if available
-                chat_history_context = ""
-                if user_id:
-                    previous_interactions = self.get_recent_chat_history(user_id, org_id, limit=3)
-                    if previous_interactions:
-                        chat_history_context = "\nPrevious interactions:\n"
-                        for idx, interaction in enumerate(previous_interactions, 1):
-                            chat_history_context += f"Q{idx}: {interaction['question']}\nA{idx}: {interaction['answer']}\n\n"
+            return RetrievalResult.from_error(e)
+
+    def get_chat_history_context(self, user_id, org_id=None, cached_only=False):
+        """
+        Build the <chat_history> block: a rolling summary plus the latest turn,
+        or the last three full turns when rolling summaries are disabled.
+        With cached_only, no round trips are made and None is returned when the
+        history is not already cached.
+        """
+        if self.summarizer.enabled:
+            if cached_only:
+                return self.summarizer.build_history_context(user_id, org_id, fetch_on_miss=False)
+            return self.summarizer.build_history_context(user_id, org_id)
+        if cached_only:
+            return None
 
-                prompt = f"""
+        chat_history_context = ""
+        previous_interactions = self.get_recent_chat_history(user_id, org_id, limit=BASELINE_TURNS)
+        if previous_interactions:
+            chat_history_context = "\nPrevious interactions:\n"
+            for idx, interaction in enumerate(previous_interactions, 1):
+                chat_history_context += f"Q{idx}: {interaction['question']}\nA{idx}: {interaction['answer']}\n\n"
+        return chat_history_context
+
+    def build_rag_prompt(self, question, context_text, chat_history_context=""):
+        """Assemble the RAG prompt from rendered context and chat history"""
+        return f"""
                You are a specialized medical assistant designed to assist healthcare providers in extracting and analyzing patient information from medical records, discharge summaries, clinical notes, and external lab reports. Your goal is to provide accurate, concise medical information based solely on the data within the <context> and </context> tags, while considering prior interactions in the <chat_history> and </chat_history> tags.
 
         ### Guidelines for Answering
@@ -209,7 +263,7 @@ class DocumentAssistant:
         </chat_history>
 
         <context>
-        {prompt_context}
+        {context_text}
         </context>
 
         <question>
@@ -218,8 +272,35 @@ class DocumentAssistant:
 
                 """
 
-                json_data = json.loads(prompt_context) if isinstance(prompt_context, str) else prompt_context
-                relative_paths = set(item.get('relative_path', '') for item in json_data.get('results', []))
+    def create_prompt(self, question, use_rag=True, category="ALL", user_id=None, org_id=None, include_history=True):
+        """
+        Creates a prompt for Cortex complete API with or without RAG context.
+        Returns (prompt, relative_paths, grounded) where grounded is True only
+        when retrieval succeeded and returned context.
+        """
+        grounded = False
+        if use_rag:
+            try:
+                retrieval = self.get_similar_chunks(question, category)
+
+                # Include user_id and org_id in the prompt if provided
+                user_context = ""
+                if user_id or org_id:
+                    user_context = f"""
+                    Additional context:
+                    User ID: {user_id if user_id else 'Not provided'}
+                    Organization ID: {org_id if org_id else 'Not provided'}
+                    """
+
+                # Include previous interaction context if available
+                chat_history_context = ""
+                if user_id and include_history:
+                    chat_history_context = self.get_chat_history_context(user_id, org_id)
+
+                prompt = self.build_rag_prompt(question, retrieval.context_text(), chat_history_context)
+
+                relative_paths = retrieval.relative_paths
+                grounded = retrieval.error is None and bool(retrieval.chunks)
 
             except Exception as e:
                 logging.exception(f"Error creating RAG prompt: {e}")
@@ -237,24 +318,58 @@ class DocumentAssistant:
             """
             relative_paths = set()
 
-        return prompt, relative_paths
+        return prompt, relative_paths, grounded
 
-    def get_answer(self, question, model_name=DEFAULT_MODEL, use_rag=True, category="ALL", user_id=None, org_id=None):
-        """Process a question and return an answer using Cortex complete API"""
+    def get_answer(self, question, model_name=DEFAULT_MODEL, use_rag=True, category="ALL", user_id=None, org_id=None, degraded=False):
+        """
+        Process a question and return an answer using Cortex complete API.
+        In degraded mode optional stages (chat history context and KB suggested
+        questions) are skipped to reduce warehouse load.
+        """
         max_retries = 1 # Allow one retry after re-authentication
+        cache_answers = use_rag and self.answer_cache_allowed(category)
+        # Answers conditioned on a user's chat history are only ever reused for that same user/org
+        if user_id and not degraded:
+            answer_key = (normalize_question(question), category, model_name, user_id, org_id or "")
+        else:
+            answer_key = (normalize_question(question), category, model_name)
         for attempt in range(max_retries + 1):
             try:
-                prompt, relative_paths = self.create_prompt(question, use_rag, category, user_id, org_id)
+                cached_answer = self.answer_cache.get(answer_key) if cache_answers else None
+                if cached_answer is None and use_rag and self.answer_procedure is not None:
+                    result = self._get_answer_server_side(question, model_name, category, user_id, org_id, degraded)
+                    if result is not None:
+                        # Only cache answers grounded in retrieved context
+                        if cache_answers and result["related_documents"]:
+                            self.answer_cache.set(answer_key, (result["answer"], set(result["related_documents"])))
+                        return result
+
+                if cached_answer is not None:
+                    response_text, relative_paths = cached_answer
+                else:
+                    prompt, relative_paths, grounded = self.create_prompt(question, use_rag, category, user_id, org_id, include_history=not degraded)
 
-                cmd = """
-                    select snowflake.cortex.complete(?, ?) as response
-                """
+                    cmd = """
+                        select snowflake.cortex.complete(?, ?) as response
+                    """
 
-                df_response = self.session.sql(cmd, params=[model_name, prompt]).collect()
-                response_text = df_response[0].RESPONSE
+                    started = time.monotonic()
+                    df_response = self.session.sql(cmd, params=[model_name, prompt]).collect()
+                    response_text = df_response[0].RESPONSE
+                    if not (user_id and use_rag and not degraded):
+                        history_mode = "none"
+                    else:
+                        history_mode = "summary" if self.summarizer.enabled else "full"
+                    self.summarizer.record_completion(history_mode, time.monotonic() - started)
+                    # Answers built without retrieved context (search errors, bare fallback prompt) are not cached
+                    if cache_answers and grounded:
+                        self.answer_cache.set(answer_key, (response_text, relative_paths))
 
                 # Generate suggested questions based on the original question
-                suggested_questions = self.get_suggested_questions_from_kb(question, category)
+                if degraded:
+                    suggested_questions = self.generate_fallback_questions()
+                else:
+                    suggested_questions = self.get_suggested_questions_from_kb(question, category)
 
                 # Store interaction in chat history
                 if user_id:
@@ -268,6 +383,7 @@ class DocumentAssistant:
                         related_documents=list(relative_paths),
                         suggested_questions=suggested_questions
                     )
+                    self.summarizer.schedule(user_id, org_id, question, response_text)
 
                 return {
                     "answer": response_text,
@@ -301,6 +417,81 @@ class DocumentAssistant:
                     "suggested_questions": self.generate_fallback_questions()
                 }
 
+    def _get_answer_server_side(self, question, model_name, category, user_id, org_id, degraded):
+        """
+        Answer with a single CALL to the server-side pipeline. Returns None to fall
+        back to the client path only when the CALL did not produce an answer; once
+        it has, the answer is returned even if later bookkeeping fails.
+        """
+        try:
+            # Cached history is rendered here; otherwise the procedure reads the same turns the client path would
+            chat_history_context = ""
+            history_header, history_turns = "", 0
+            if user_id and not degraded:
+                chat_history_context = self.get_chat_history_context(user_id, org_id, cached_only=True)
+                if chat_history_context is None:
+                    chat_history_context = HISTORY_PLACEHOLDER
+                    if self.summarizer.enabled:
+                        history_header, history_turns = "\nMost recent interaction:\n", 1
+                    else:
+                        history_header, history_turns = "\nPrevious interactions:\n", BASELINE_TURNS
+            prompt_template = self.build_rag_prompt(question, CONTEXT_PLACEHOLDER, chat_history_context)
+
+            # On a cold suggestion cache the fallback questions are stored and returned with this answer,
+            # and the questions extracted from the scanned chunks serve the following requests
+            suggestion_key = (category, MIN_SUGGESTED_QUESTIONS)
+            cached_suggestions = None if degraded else self.suggestion_cache.get(suggestion_key)
+            scan_suggestions = not degraded and cached_suggestions is None
+            suggested_questions = list(cached_suggestions or self.generate_fallback_questions())
+
+            started = time.monotonic()
+            result = self.answer_procedure(
+                question=question,
+                category=category,
+                model_name=model_name,
+                prompt_template=prompt_template,
+                num_chunks=NUM_CHUNKS,
+                user_id=user_id,
+                org_id=org_id,
+                suggested_questions=suggested_questions,
+                scan_suggestions=scan_suggestions,
+                history_header=history_header,
+                history_turns=history_turns
+            )
+            self.summarizer.record_completion("server_pipeline", time.monotonic() - started)
+        except Exception as e:
+            logging.exception(f"Server-side answer pipeline failed, falling back to client path: {e}")
+            return None
+
+        answer = result["answer"]
+        related_documents = list(result.get("sources") or [])
+        try:
+            if scan_suggestions:
+                self.suggestion_cache.set(suggestion_key, self.extract_suggested_questions(result.get("suggestion_chunks") or []))
+            if user_id and not result.get("history_stored"):
+                logging.info("Answer procedure could not store chat history, skipping storage")
+            if user_id:
+                self.summarizer.schedule(user_id, org_id, question, answer)
+        except Exception as e:
+            logging.exception(f"Error finishing server-side answer: {e}")
+
+        return {
+            "answer": answer,
+            "related_documents": related_documents,
+            "suggested_questions": suggested_questions
+        }
+
+    def answer_cache_allowed(self, category):
+        """
+        Answers are only cached for categories whose content is not user specific.
+        Even then, answers whose prompt carried a user's chat history are keyed by user/org.
+        """
+        return "*" in ANSWER_CACHE_CATEGORIES or category in ANSWER_CACHE_CATEGORIES
+
+    def get_cache_stats(self):
+        """Return hit/miss statistics for the assistant's caches"""
+        return [cache.get_stats() for cache in (self.retrieval_cache, self.suggestion_cache, self.answer_cache, self.catalog_cache)]
+
     def store_chat_history(self, user_id, org_id, question, answer, model_name, category, related_documents=None, suggested_questions=None):
         """Store chat interaction in the history table"""
         try:
@@ -453,6 +644,12 @@ class DocumentAssistant:
 
     def get_suggested_questions_from_kb(self, question, category="ALL", min_questions=MIN_SUGGESTED_QUESTIONS):
         """Get suggested questions from knowledge base stored in stage docs"""
+        # The KB scan only depends on the category, so cache per category
+        cache_key = (category, min_questions)
+        cached = self.suggestion_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
         try:
             # Instead of using vector search, query specifically for questions in docs
             if category != "ALL":
@@ -471,46 +668,42 @@ class DocumentAssistant:
                 """
                 df_chunks = self.session.sql(query).collect()
 
-            # Extract questions from the results
-            suggested_questions = []
-            for row in df_chunks:
-                chunk_text = row.CHUNK
-                # Split by sentence endings and question marks
-                for sentence in self._split_into_sentences(chunk_text):
-                    sentence = sentence.strip()
-                    if sentence.endswith("?") and len(sentence) > 10 and len(sentence) < 100:
-                        # Check if this is a reasonable question and not too similar to existing ones
-                        if not any(self._is_similar_question(sentence, q) for q in suggested_questions):
-                            suggested_questions.append(sentence)
-                            if len(suggested_questions) >= min_questions:
-                                break
-                if len(suggested_questions) >= min_questions:
-                    break
-
-            # If we don't have enough questions, use fallback
-            if len(suggested_questions) < min_questions:
-                suggested_questions.extend(self.generate_fallback_questions()[:min_questions-len(suggested_questions)])
-
-            return suggested_questions[:min_questions]
+            suggested_questions = self.extract_suggested_questions([row.CHUNK for row in df_chunks], min_questions)
+            self.suggestion_cache.set(cache_key, suggested_questions)
+            return suggested_questions
         except Exception as e:
             logging.exception(f"Error generating suggested questions from KB: {e}")
             return self.generate_fallback_questions()
 
+    def extract_suggested_questions(self, chunk_texts, min_questions=MIN_SUGGESTED_QUESTIONS):
+        """Extract distinct short questions from KB chunks, topped up with fallback questions"""
+        suggested_questions = []
+        for chunk_text in chunk_texts:
+            # Split by sentence endings and question marks
+            for sentence in self._split_into_sentences(chunk_text):
+                sentence = sentence.strip()
+                if sentence.endswith("?") and len(sentence) > 10 and len(sentence) < 100:
+                    # Check if this is a reasonable question and not too similar to existing ones
+                    if not any(self._is_similar_question(sentence, q) for q in suggested_questions):
+                        suggested_questions.append(sentence)
+                        if len(suggested_questions) >= min_questions:
+                            break
+            if len(suggested_questions) >= min_questions:
+                break
+
+        # If we don't have enough questions, use fallback
+        if len(suggested_questions) < min_questions:
+            suggested_questions.extend(self.generate_fallback_questions()[:min_questions-len(suggested_questions)])
+
+        return suggested_questions[:min_questions]
+
     def _generate_questions_from_kb(self, question, category="ALL", num_questions=4):
         """Generate questions from knowledge base using the LLM"""
         try:
             # Get relevant chunks from the knowledge base
-            context_data = self.get_similar_chunks(question, category, num_chunks=5)
-
-            # Parse the context
-            if isinstance(context_data, str):
-                context_data = json.loads(context_data)
+            retrieval = self.get_similar_chunks(question, category, num_chunks=5)
 
-            context_text = ""
-            for item in context_data.get('results', []):
-                chunk = item.get('chunk', '')
-                if chunk:
-                    context_text += chunk + "\n\n"
+            context_text = "".join(item.chunk + "\n\n" for item in retrieval.chunks if item.chunk)
 
             # Create a prompt to generate questions based on the knowledge base
             prompt = f"""
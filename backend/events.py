@@ -0,0 +1,92 @@
+"""
+Event bus for cache invalidation.
+
+Subscribers are called in the publishing process right away. Events
+published with shared=True are also written to a small file in the private
+cache directory, and every other process delivers them to its own
+subscribers the next time it calls poll() (main.py does so before each
+request), so a run of the ingestion CLI invalidates every worker's caches.
+"""
+import os
+import time
+import threading
+import logging
+from collections import defaultdict
+from cache import CACHE_DIR, write_private_json, read_private_json
+
+# Event types
+STAGE_CHANGED = "stage_changed"  # Payload: {"added": [...], "changed": [...], "deleted": [...]}
+
+EVENT_POLL_SECONDS = 1.0  # Minimum time between checks for events published by other processes
+
+_subscribers = defaultdict(list)
+_seen = {}  # Stamp of the last shared event of each type already delivered in this process
+_last_poll = 0.0
+_lock = threading.Lock()
+
+
+def _event_file(event_type):
+    return f"{event_type}.event"
+
+
+def _stamp(event_type):
+    """Identify the latest shared event; every publish replaces the file with a new inode"""
+    try:
+        info = os.stat(os.path.join(CACHE_DIR, _event_file(event_type)))
+    except OSError:
+        return None
+    return (info.st_ino, info.st_mtime_ns)
+
+
+def subscribe(event_type, callback):
+    """Register a callback to be invoked with the payload of each published event"""
+    with _lock:
+        _subscribers[event_type].append(callback)
+        # Only events shared after subscribing are delivered
+        _seen.setdefault(event_type, _stamp(event_type))
+
+
+def unsubscribe(event_type, callback):
+    with _lock:
+        if callback in _subscribers[event_type]:
+            _subscribers[event_type].remove(callback)
+
+
+def _deliver(event_type, payload):
+    with _lock:
+        callbacks = list(_subscribers[event_type])
+    for callback in callbacks:
+        try:
+            callback(payload)
+        except Exception as e:
+            logging.exception(f"Error handling {event_type} event: {e}")
+
+
+def publish(event_type, payload=None, shared=True):
+    """Deliver an event to all subscribers; a failing subscriber does not stop the others"""
+    if shared:
+        try:
+            write_private_json(_event_file(event_type), payload)
+            with _lock:
+                _seen[event_type] = _stamp(event_type)
+        except (OSError, RuntimeError, TypeError) as e:
+            logging.error(f"Could not share {event_type} event with other processes: {e}")
+    _deliver(event_type, payload)
+
+
+def poll():
+    """Deliver events shared by other processes since the last check; cheap enough to call per request"""
+    global _last_poll
+    now = time.monotonic()
+    with _lock:
+        if now - _last_poll < EVENT_POLL_SECONDS:
+            return
+        _last_poll = now
+        due = []
+        for event_type in list(_subscribers):
+            stamp = _stamp(event_type)
+            if stamp is not None and stamp != _seen.get(event_type):
+                _seen[event_type] = stamp
+                due.append(event_type)
+    for event_type in due:
+        _deliver(event_type, read_private_json(_event_file(event_type)))
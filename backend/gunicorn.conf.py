@@ -0,0 +1,46 @@
+"""
+Pre-fork multi-worker serving mode.
+
+Each worker imports main.py itself (no preload), so every worker owns its
+own DocumentAssistant and Snowflake sessions. Retrieval, catalog, suggestion,
+answer and summary caches are shared between workers through a SQLite file
+(see cache.SqliteCache), so adding workers adds CPU for JSON handling,
+prompt building and suggestion extraction without multiplying warehouse
+queries or cache misses.
+
+Usage: gunicorn -c gunicorn.conf.py main:app
+"""
+import os
+import multiprocessing
+
+# Workers share caches through the embedded store unless explicitly overridden
+os.environ.setdefault("CACHE_BACKEND", "sqlite")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Threads let each worker overlap Snowflake waits and give admission control concurrency to schedule
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Admission control runs per worker: host-wide rates are divided across workers, and
+# fewer in-flight slots than threads leaves room for requests to queue fairly
+os.environ.setdefault("ADMISSION_WORKERS", str(workers))
+os.environ.setdefault("ADMISSION_MAX_IN_FLIGHT", str(max(1, threads // 2)))
+worker_class = "gthread"
+timeout = 300
+preload_app = False
+
+
+def on_starting(server):
+    """Start every deploy with an empty shared cache in a private directory"""
+    from cache import CACHE_DIR, CACHE_SQLITE_PATH, ensure_cache_dir
+    from admission import LOAD_FILE_PREFIX
+
+    ensure_cache_dir()
+    for suffix in ("", "-wal", "-shm"):
+        path = CACHE_SQLITE_PATH + suffix
+        if os.path.exists(path):
+            os.remove(path)
+    # Load shared by workers of a previous run
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(LOAD_FILE_PREFIX):
+            os.remove(os.path.join(CACHE_DIR, name))
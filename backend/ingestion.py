@@ -0,0 +1,442 @@
+"""
+Incremental ingestion of the @docs stage into docs_chunks_table.
+
+The stage listing is diffed against a manifest table by path, size and
+checksum. Only new or changed files are parsed (server side with
+PARSE_DOCUMENT), chunked and categorized in a process pool, and written back
+in bulk. Chunks of deleted files, and any chunks whose file is no longer on
+the stage, are removed. Files that fail to parse or chunk are skipped and
+reported, and retried on the next run. A run that would delete more than
+INGEST_MAX_DELETE_FRACTION of the chunks (or sees an empty stage) is
+refused unless forced. A shared STAGE_CHANGED event is published afterwards
+so every worker invalidates its caches.
+
+Files that already have chunks keep their existing category; only new
+files are categorized by their top-level folder. On a table that was
+populated before the manifest existed, the first run must be started with
+--seed-manifest, which records every stage file that already has chunks as
+ingested in its current state instead of reparsing the whole corpus.
+
+Run from the command line with `python ingestion.py [--force] [--seed-manifest]`. The
+/api/ingestion/run endpoint starts that same command in a separate process,
+so the spawned chunking pool never re-imports the web app.
+"""
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+import logging
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from document_assistant import CORTEX_SEARCH_DATABASE, CORTEX_SEARCH_SCHEMA, create_session
+from cache import CACHE_DIR, ensure_cache_dir, write_private_json, read_private_json
+import events
+
+# Default configuration values
+DOCS_STAGE = "docs"
+DOCS_CHUNKS_TABLE = "docs_chunks_table"
+DOCS_MANIFEST_TABLE = "DOCS_MANIFEST"  # Table recording the last ingested state of each file
+CHUNK_SIZE = int(os.environ.get("INGEST_CHUNK_SIZE", 1500))  # Characters per chunk
+CHUNK_OVERLAP = int(os.environ.get("INGEST_CHUNK_OVERLAP", 200))  # Characters shared by neighbouring chunks
+PARSE_BATCH_SIZE = int(os.environ.get("INGEST_PARSE_BATCH_SIZE", 10))  # Files parsed per PARSE_DOCUMENT statement
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 2))  # Processes used for chunking
+INGEST_MAX_DELETE_FRACTION = float(os.environ.get("INGEST_MAX_DELETE_FRACTION", 0.5))  # Largest share of chunks a run may delete without --force
+DEFAULT_CATEGORY = "GENERAL"  # Category for files stored at the root of the stage
+STATUS_FILE = "ingestion.last_run.json"  # Summary of the last run, shared by all workers
+LOCK_FILE = "ingestion.lock"  # flock held by the process running ingestion, so only one runs per host
+
+_SEPARATORS = ["\n\n", "\n", ". ", " "]
+_CATEGORY_CLEANUP = re.compile(r"[^A-Z0-9]+")
+
+
+def assign_category(relative_path):
+    """Categories follow the top-level folder of the file on the stage"""
+    if "/" not in relative_path:
+        return DEFAULT_CATEGORY
+    folder = relative_path.split("/", 1)[0]
+    return _CATEGORY_CLEANUP.sub("_", folder.upper()).strip("_") or DEFAULT_CATEGORY
+
+
+def split_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks, preferring paragraph, line, sentence and word boundaries"""
+    text = text.strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            window = text[start:end]
+            for separator in _SEPARATORS:
+                cut = window.rfind(separator)
+                if cut > chunk_overlap:
+                    end = start + cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - chunk_overlap, start + 1)
+    return chunks
+
+
+def chunk_document(document):
+    """Process pool worker: turn one parsed (relative_path, content, category) document into chunk rows"""
+    relative_path, content, category = document
+    return [
+        {"CHUNK": chunk, "RELATIVE_PATH": relative_path, "CATEGORY": category}
+        for chunk in split_text(content or "")
+    ]
+
+
+class IngestionRefused(Exception):
+    """Raised when a run would delete too much of the chunk table or reparse an unmanifested corpus"""
+
+
+class IngestionPipeline:
+    """
+    Keeps docs_chunks_table in sync with the @docs stage.
+
+    Each run opens its own Snowflake session so that its explicit
+    transactions never wrap statements issued by request threads, and holds
+    an flock on a file in the private cache directory so that runs started
+    from the CLI or from any worker process never overlap.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS):
+        self.session = None
+        self.workers = workers
+        self._process = None
+
+    def _open_lock_file(self):
+        ensure_cache_dir()
+        return os.fdopen(os.open(os.path.join(CACHE_DIR, LOCK_FILE), os.O_CREAT | os.O_RDWR | os.O_NOFOLLOW, 0o600), "w")
+
+    def _acquire_lock(self):
+        """Return the locked lock file, or None if another process is running ingestion"""
+        lock_file = self._open_lock_file()
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @property
+    def running(self):
+        """True while any process on the host is running ingestion, or the one started here is starting up"""
+        if self._process is not None and self._process.poll() is None:
+            return True
+        try:
+            lock_file = self._acquire_lock()
+        except (OSError, RuntimeError) as e:
+            logging.error(f"Ingestion lock unavailable: {e}")
+            return False
+        if lock_file is None:
+            return True
+        lock_file.close()
+        return False
+
+    @property
+    def last_run(self):
+        return read_private_json(STATUS_FILE)
+
+    def _record_run(self, summary):
+        try:
+            write_private_json(STATUS_FILE, summary)
+        except (OSError, RuntimeError) as e:
+            logging.error(f"Could not record ingestion status: {e}")
+        return summary
+
+    def _qualified(self, table):
+        return f"{CORTEX_SEARCH_DATABASE}.{CORTEX_SEARCH_SCHEMA}.{table}"
+
+    def _ensure_manifest_table(self):
+        self.session.sql(f"""
+            CREATE TABLE IF NOT EXISTS {self._qualified(DOCS_MANIFEST_TABLE)} (
+                relative_path STRING,
+                size NUMBER,
+                md5 STRING,
+                category STRING,
+                chunk_count NUMBER,
+                ingested_at TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+            )
+        """).collect()
+
+    def list_stage(self):
+        """Return {relative_path: (size, md5)} for every file on the stage"""
+        files = {}
+        for row in self.session.sql(f"ls @{DOCS_STAGE}").collect():
+            # ls reports names prefixed with the stage name, e.g. docs/reports/a.pdf
+            relative_path = row["name"].split("/", 1)[1] if "/" in row["name"] else row["name"]
+            files[relative_path] = (int(row["size"]), row["md5"])
+        return files
+
+    def load_manifest(self):
+        rows = self.session.sql(f"SELECT relative_path, size, md5 FROM {self._qualified(DOCS_MANIFEST_TABLE)}").collect()
+        return {row.RELATIVE_PATH: (int(row.SIZE), row.MD5) for row in rows}
+
+    def diff(self, stage_files, manifest):
+        """Split stage contents into added, changed and deleted paths"""
+        added = sorted(path for path in stage_files if path not in manifest)
+        changed = sorted(path for path in stage_files if path in manifest and stage_files[path] != manifest[path])
+        deleted = sorted(path for path in manifest if path not in stage_files)
+        return added, changed, deleted
+
+    def seed_manifest(self, stage_files):
+        """Record stage files that already have chunks as ingested, keeping their chunks and category"""
+        stage_df = pd.DataFrame(
+            [{"RELATIVE_PATH": path, "SIZE": size, "MD5": md5} for path, (size, md5) in stage_files.items()],
+            columns=["RELATIVE_PATH", "SIZE", "MD5"]
+        )
+        self.session.write_pandas(stage_df, "INGEST_STAGE_LISTING", auto_create_table=True, overwrite=True, table_type="temporary")
+        self.session.sql(f"""
+            MERGE INTO {self._qualified(DOCS_MANIFEST_TABLE)} m
+            USING (
+                SELECT l.relative_path, l.size, l.md5, c.category, c.chunk_count
+                FROM INGEST_STAGE_LISTING l
+                JOIN (
+                    SELECT relative_path, ANY_VALUE(category) AS category, COUNT(*) AS chunk_count
+                    FROM {DOCS_CHUNKS_TABLE}
+                    GROUP BY relative_path
+                ) c ON c.relative_path = l.relative_path
+            ) s ON m.relative_path = s.relative_path
+            WHEN NOT MATCHED THEN INSERT (relative_path, size, md5, category, chunk_count)
+                VALUES (s.relative_path, s.size, s.md5, s.category, s.chunk_count)
+        """).collect()
+
+    def load_categories(self, paths):
+        """Return {relative_path: category} for the given files that already have chunks"""
+        if not paths:
+            return {}
+        rows = self.session.sql(f"""
+            SELECT relative_path, ANY_VALUE(category) AS category
+            FROM {DOCS_CHUNKS_TABLE}
+            WHERE ARRAY_CONTAINS(relative_path::variant, PARSE_JSON(?))
+            GROUP BY relative_path
+        """, params=[json.dumps(paths)]).collect()
+        return {row.RELATIVE_PATH: row.CATEGORY for row in rows if row.CATEGORY}
+
+    def check_run(self, stage_files, manifest):
+        """
+        Refuse runs that would wipe the chunk table (e.g. after an empty or partial
+        stage listing) or reparse a corpus that was ingested before the manifest existed
+        """
+        row = self.session.sql(f"""
+            SELECT COUNT(*) AS total,
+                   COUNT_IF(NOT ARRAY_CONTAINS(relative_path::variant, PARSE_JSON(?))) AS orphaned
+            FROM {DOCS_CHUNKS_TABLE}
+        """, params=[json.dumps(sorted(stage_files))]).collect()[0]
+        if not row.TOTAL:
+            return
+        if not manifest:
+            raise IngestionRefused(
+                f"Manifest is empty but {DOCS_CHUNKS_TABLE} holds {row.TOTAL} chunks; "
+                f"run with --seed-manifest to adopt them, or --force to reparse every file"
+            )
+        if not stage_files:
+            raise IngestionRefused(f"Stage listing is empty but {DOCS_CHUNKS_TABLE} holds {row.TOTAL} chunks")
+        if row.ORPHANED / row.TOTAL > INGEST_MAX_DELETE_FRACTION:
+            raise IngestionRefused(
+                f"Run would delete {row.ORPHANED} of {row.TOTAL} chunks, "
+                f"more than INGEST_MAX_DELETE_FRACTION={INGEST_MAX_DELETE_FRACTION}"
+            )
+
+    def _parse(self, paths):
+        """Parse a batch of staged files in a single PARSE_DOCUMENT statement"""
+        query = f"""
+            SELECT f.value::string AS relative_path,
+                   TO_VARCHAR(SNOWFLAKE.CORTEX.PARSE_DOCUMENT('@{DOCS_STAGE}', f.value::string, {{'mode': 'LAYOUT'}}):content) AS content
+            FROM TABLE(FLATTEN(INPUT => PARSE_JSON(?))) f
+        """
+        rows = self.session.sql(query, params=[json.dumps(paths)]).collect()
+        return [(row.RELATIVE_PATH, row.CONTENT) for row in rows]
+
+    def _parse_batch(self, paths):
+        """Parse a batch, retrying file by file when it fails; returns (documents, {path: error})"""
+        try:
+            return self._parse(paths), {}
+        except Exception as e:
+            if len(paths) == 1:
+                return [], {paths[0]: str(e)}
+            logging.warning(f"Parsing a batch of {len(paths)} files failed, retrying them one at a time: {e}")
+        documents = []
+        failed = {}
+        for path in paths:
+            try:
+                documents.extend(self._parse([path]))
+            except Exception as e:
+                failed[path] = str(e)
+        return documents, failed
+
+    def _chunk_batch(self, pool, documents, categories):
+        """Chunk parsed documents in the pool; returns ({path: chunk rows}, {path: error})"""
+        futures = {
+            path: pool.submit(chunk_document, (path, content, categories.get(path) or assign_category(path)))
+            for path, content in documents
+        }
+        chunked = {}
+        failed = {}
+        for path, future in futures.items():
+            try:
+                chunked[path] = future.result()
+            except Exception as e:
+                failed[path] = str(e)
+        return chunked, failed
+
+    def _write_batch(self, paths, chunk_rows, stage_files, categories):
+        """Replace the chunks of a batch of files and update their manifest entries in one transaction"""
+        chunks_df = pd.DataFrame(chunk_rows, columns=["CHUNK", "RELATIVE_PATH", "CATEGORY"])
+        manifest_df = pd.DataFrame(
+            [
+                {
+                    "RELATIVE_PATH": path,
+                    "SIZE": stage_files[path][0],
+                    "MD5": stage_files[path][1],
+                    "CATEGORY": categories.get(path) or assign_category(path),
+                    "CHUNK_COUNT": int((chunks_df["RELATIVE_PATH"] == path).sum())
+                }
+                for path in paths
+            ]
+        )
+        self.session.write_pandas(chunks_df, "INGEST_CHUNKS_STAGING", auto_create_table=True, overwrite=True, table_type="temporary")
+        self.session.write_pandas(manifest_df, "INGEST_MANIFEST_STAGING", auto_create_table=True, overwrite=True, table_type="temporary")
+
+        self.session.sql("BEGIN").collect()
+        try:
+            self.session.sql(f"""
+                DELETE FROM {DOCS_CHUNKS_TABLE}
+                WHERE relative_path IN (SELECT relative_path FROM INGEST_MANIFEST_STAGING)
+            """).collect()
+            self.session.sql(f"""
+                INSERT INTO {DOCS_CHUNKS_TABLE} (chunk, relative_path, category)
+                SELECT chunk, relative_path, category FROM INGEST_CHUNKS_STAGING
+            """).collect()
+            self.session.sql(f"""
+                MERGE INTO {self._qualified(DOCS_MANIFEST_TABLE)} m
+                USING INGEST_MANIFEST_STAGING s ON m.relative_path = s.relative_path
+                WHEN MATCHED THEN UPDATE SET size = s.size, md5 = s.md5, category = s.category,
+                    chunk_count = s.chunk_count, ingested_at = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN INSERT (relative_path, size, md5, category, chunk_count)
+                    VALUES (s.relative_path, s.size, s.md5, s.category, s.chunk_count)
+            """).collect()
+            self.session.sql("COMMIT").collect()
+        except Exception:
+            self.session.sql("ROLLBACK").collect()
+            raise
+
+    def _delete_orphans(self, deleted, stage_files):
+        """Remove chunks and manifest entries of files that are no longer on the stage"""
+        stage_paths = json.dumps(sorted(stage_files))
+        self.session.sql("BEGIN").collect()
+        try:
+            self.session.sql(f"""
+                DELETE FROM {DOCS_CHUNKS_TABLE}
+                WHERE NOT ARRAY_CONTAINS(relative_path::variant, PARSE_JSON(?))
+            """, params=[stage_paths]).collect()
+            if deleted:
+                self.session.sql(f"""
+                    DELETE FROM {self._qualified(DOCS_MANIFEST_TABLE)}
+                    WHERE ARRAY_CONTAINS(relative_path::variant, PARSE_JSON(?))
+                """, params=[json.dumps(deleted)]).collect()
+            self.session.sql("COMMIT").collect()
+        except Exception:
+            self.session.sql("ROLLBACK").collect()
+            raise
+
+    def run(self, force=False, seed_manifest=False):
+        """Run one incremental ingestion pass; returns a summary of what changed"""
+        try:
+            lock_file = self._acquire_lock()
+        except (OSError, RuntimeError) as e:
+            logging.error(f"Ingestion lock unavailable, not running: {e}")
+            return None
+        if lock_file is None:
+            logging.info("Ingestion already running, skipping")
+            return None
+        try:
+            started = time.monotonic()
+            self.session = create_session()
+            self._ensure_manifest_table()
+            stage_files = self.list_stage()
+            if seed_manifest:
+                self.seed_manifest(stage_files)
+            manifest = self.load_manifest()
+            added, changed, deleted = self.diff(stage_files, manifest)
+            pending = added + changed
+            logging.info(f"Ingestion diff: {len(added)} added, {len(changed)} changed, {len(deleted)} deleted")
+
+            if not force:
+                try:
+                    self.check_run(stage_files, manifest)
+                except IngestionRefused as e:
+                    logging.error(f"Ingestion refused, rerun with --force if this is intended: {e}")
+                    return self._record_run({"refused": str(e), "finished_at": time.time()})
+
+            chunk_count = 0
+            failed = {}
+            if pending:
+                # Files that already have chunks keep the category that answers, history and caches use
+                categories = self.load_categories(pending)
+                # Spawned workers start clean instead of inheriting this process's threads and sessions
+                with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    for i in range(0, len(pending), PARSE_BATCH_SIZE):
+                        batch = pending[i:i + PARSE_BATCH_SIZE]
+                        documents, parse_failed = self._parse_batch(batch)
+                        chunked, chunk_failed = self._chunk_batch(pool, documents, categories)
+                        failed.update(parse_failed)
+                        failed.update(chunk_failed)
+                        # Failed files keep their previous chunks and manifest entry so the next run retries them
+                        ingested = [path for path in batch if path in chunked]
+                        if ingested:
+                            chunk_rows = [row for path in ingested for row in chunked[path]]
+                            self._write_batch(ingested, chunk_rows, stage_files, categories)
+                            chunk_count += len(chunk_rows)
+                        logging.info(f"Ingested {len(ingested)}/{len(batch)} files ({chunk_count} chunks so far)")
+            for path, error in failed.items():
+                logging.error(f"Could not ingest {path}: {error}")
+            added = [path for path in added if path not in failed]
+            changed = [path for path in changed if path not in failed]
+
+            self._delete_orphans(deleted, stage_files)
+
+            summary = {
+                "added": added,
+                "changed": changed,
+                "deleted": deleted,
+                "failed": failed,
+                "chunks_written": chunk_count,
+                "duration_seconds": round(time.monotonic() - started, 2),
+                "finished_at": time.time()
+            }
+            if added or changed or deleted:
+                events.publish(events.STAGE_CHANGED, {"added": added, "changed": changed, "deleted": deleted})
+            return self._record_run(summary)
+        finally:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            # Closing the file releases the lock
+            lock_file.close()
+
+    def run_in_background(self):
+        """Start a run of the CLI in a separate process; returns False if one is already in progress"""
+        if self.running:
+            return False
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        return True
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(IngestionPipeline().run(force="--force" in sys.argv[1:], seed_manifest="--seed-manifest" in sys.argv[1:]), indent=2))
@@ -1,7 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import uuid
 import os
-import json
+import re
 from document_assistant import DocumentAssistant
+from admission import AdmissionController, AdmissionRejected
+from cache_warmer import CacheWarmer, WARMER_ENABLED
+from sql_profiler import profiler
+from retrieval import dumps
+from ingestion import IngestionPipeline
+import events
 from flask_cors import CORS # Import CORS
 from dotenv import load_dotenv
 import traceback
@@ -21,6 +28,49 @@ CORS(app, resources={r"/api/*": {"origins": allowed_origins}}) # Configure CORS
 # Initialize the DocumentAssistant
 assistant = DocumentAssistant()
 
+# Per-organization admission control for Snowflake-bound requests
+admission = AdmissionController()
+admission.start_load_publisher()
+
+# Pre-warm caches with popular questions from chat history
+warmer = CacheWarmer(assistant, admission)
+if WARMER_ENABLED:
+    warmer.start()
+
+# Incremental @docs ingestion; publishes stage-change events that clear the caches above
+ingestion = IngestionPipeline()
+
+# Reverse proxies in front of the app whose X-Forwarded-For entries are trusted (e.g. 1 behind Nginx)
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+
+def client_address():
+    """Address of the calling client, used to key admission control for requests without an org_id"""
+    forwarded = [addr.strip() for addr in request.headers.get('X-Forwarded-For', '').split(',') if addr.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.remote_addr
+
+# Client-supplied request ids end up in QUERY_TAG and logs, so only short plain tokens are accepted
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+@app.before_request
+def start_sql_profile():
+    """Tie all Snowflake round trips of this request to a request id / QUERY_TAG"""
+    request_id = request.headers.get('X-Request-ID', '')
+    if not REQUEST_ID_PATTERN.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    profiler.start_request(request_id, request.path)
+    # Pick up cache invalidations published by ingestion runs in other processes
+    events.poll()
+
+@app.after_request
+def end_sql_profile(response):
+    profile = profiler.end_request()
+    if profile is not None:
+        response.headers['X-Request-ID'] = profile.request_id
+        response.headers['X-SQL-Round-Trips'] = str(len(profile.statements))
+    return response
+
 @app.route('/api/search', methods=['POST'])
 def search():
     """
@@ -52,33 +102,44 @@ def search():
         use_rag = data.get('use_rag', True)
         model_name = data.get('model_name', 'llama3.3-70b')  # Using llama3.3-70b
         
-        # Get answer from DocumentAssistant
-        result = assistant.get_answer(
-            question=query,
-            model_name=model_name,
-            use_rag=use_rag,
-            category=category,
-            user_id=user_id,
-            org_id=org_id
-        )
-        
-        # Format the response according to requirements
-        response = {
-            "answer": result["answer"],
-            "suggested_questions": result["suggested_questions"]
-        }
-        
-        # Optionally include document URLs if needed
-        if result.get('related_documents') and request.args.get('include_urls') == 'true':
-            doc_urls = {}
-            for doc_path in result['related_documents']:
-                url = assistant.get_document_url(doc_path)
-                if url:
-                    doc_urls[doc_path] = url
-            response['document_urls'] = doc_urls
+        # Get answer from DocumentAssistant once admitted
+        with admission.admit(org_id, user_id, client_address()) as ticket:
+            result = assistant.get_answer(
+                question=query,
+                model_name=model_name,
+                use_rag=use_rag,
+                category=category,
+                user_id=user_id,
+                org_id=org_id,
+                degraded=ticket.degraded
+            )
+            
+            # Format the response according to requirements
+            response = {
+                "answer": result["answer"],
+                "suggested_questions": result["suggested_questions"]
+            }
+            
+            # Optionally include document URLs if needed (skipped when degraded)
+            if result.get('related_documents') and request.args.get('include_urls') == 'true' and not ticket.degraded:
+                doc_urls = {}
+                for doc_path in result['related_documents']:
+                    url = assistant.get_document_url(doc_path)
+                    if url:
+                        doc_urls[doc_path] = url
+                response['document_urls'] = doc_urls
             
         return jsonify(response)
     
+    except AdmissionRejected as e:
+        # Request was shed; return 200 like other errors so clients show the busy answer instead of retrying elsewhere
+        response = jsonify({
+            "answer": "The service is busy right now. Please try again in a moment.",
+            "suggested_questions": assistant.generate_fallback_questions()
+        })
+        response.headers['Retry-After'] = str(max(1, int(round(e.retry_after))))
+        return response, 200
+    
     except Exception as e:
         traceback.print_exc()
         # Return formatted error response with fallback suggested questions
@@ -154,11 +215,24 @@ def get_raw_context():
         category = data.get('category', 'ALL')
         num_chunks = data.get('num_chunks', 3)
         
+        # Serialize the typed result exactly once, here at the HTTP edge
         context = assistant.get_similar_chunks(query, category, num_chunks)
-        return jsonify({"context": json.loads(context) if isinstance(context, str) else context})
+        return Response(dumps({"context": context.to_dict()}), mimetype='application/json')
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ingestion/run', methods=['POST'])
+def run_ingestion():
+    """Endpoint to start an incremental ingestion of the @docs stage in the background"""
+    if not ingestion.run_in_background():
+        return jsonify({"status": "already_running"}), 409
+    return jsonify({"status": "started"}), 202
+
+@app.route('/api/ingestion/status', methods=['GET'])
+def get_ingestion_status():
+    """Endpoint to retrieve the state and summary of the last ingestion run"""
+    return jsonify({"running": ingestion.running, "last_run": ingestion.last_run})
+
 # Chat history endpoints
 
 @app.route('/api/chat/history', methods=['GET'])
@@ -209,6 +283,30 @@ def get_user_stats():
     except Exception as e:
         return jsonify({"error": str(e), "total_questions": 0}), 500
 
+@app.route('/api/chat/summary_stats', methods=['GET'])
+def get_summary_stats():
+    """Endpoint to retrieve rolling summary token savings and completion latency by history mode"""
+    return jsonify(assistant.summarizer.get_stats())
+
+@app.route('/api/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """Endpoint to retrieve queue wait times, shed counts and current load"""
+    return jsonify(admission.get_stats())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Endpoint to retrieve cache hit rates and the last warming run"""
+    return jsonify({
+        "worker_pid": os.getpid(),
+        "caches": assistant.get_cache_stats(),
+        "last_warm_run": warmer.last_run
+    })
+
+@app.route('/api/debug/sql_profile', methods=['GET'])
+def get_sql_profile():
+    """Endpoint to retrieve per-fingerprint SQL statistics and recent request profiles"""
+    return jsonify(profiler.get_stats())
+
 @app.errorhandler(404)
 def not_found(e):
     return jsonify({"error": "Endpoint not found"}), 404
@@ -219,6 +317,8 @@ def server_error(e):
 
 # Add a cleanup handler to close the Snowflake session when the app is shut down
 import atexit
+atexit.register(lambda: warmer.stop())
+atexit.register(lambda: assistant.summarizer.shutdown())
 atexit.register(lambda: assistant.close())
 
 if __name__ == '__main__':
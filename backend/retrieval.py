@@ -0,0 +1,68 @@
+from dataclasses import dataclass
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library encoder
+    orjson = None
+    import json
+
+
+@dataclass(frozen=True, slots=True)
+class Chunk:
+    """A single chunk returned by Cortex Search"""
+    chunk: str
+    relative_path: str
+    category: str
+
+
+@dataclass(frozen=True, slots=True)
+class RetrievalResult:
+    """Typed retrieval result passed through the pipeline and serialized only at the HTTP edge"""
+    chunks: tuple = ()
+    error: str = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a result from Cortex Search result rows (dictionaries keyed by column)"""
+        return cls(tuple(
+            Chunk(row.get("chunk") or "", row.get("relative_path") or "", row.get("category") or "")
+            for row in rows
+        ))
+
+    @classmethod
+    def from_dict(cls, payload):
+        """Inverse of to_dict()"""
+        return cls(cls.from_rows(payload.get("results", [])).chunks, payload.get("error"))
+
+    @classmethod
+    def from_error(cls, error):
+        return cls((), str(error))
+
+    @property
+    def relative_paths(self):
+        return {item.relative_path for item in self.chunks}
+
+    def context_text(self):
+        """Render the chunks as compact prompt context"""
+        return "\n\n".join(
+            f"Source: {item.relative_path} (Category: {item.category})\n{item.chunk}"
+            for item in self.chunks
+        )
+
+    def to_dict(self):
+        payload = {
+            "results": [
+                {"chunk": item.chunk, "relative_path": item.relative_path, "category": item.category}
+                for item in self.chunks
+            ]
+        }
+        if self.error:
+            payload["error"] = self.error
+        return payload
+
+
+def dumps(payload):
+    """Serialize a payload to UTF-8 JSON bytes with the fastest available encoder"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,215 @@
+"""
+Single-round-trip answer pipeline.
+
+The Snowflake Scripting procedure below runs search preview, prompt
+assembly, cortex.complete, the suggested-question KB scan and the chat
+history read and insert server side, so a RAG answer costs one CALL
+instead of several sequential statements. When the caller has no cached
+chat history for the prompt, the procedure reads the same recent turns the
+client path would (history_turns) and renders them into the template, so
+both paths prompt with the same history whether or not rolling summaries
+are enabled. LocalAnswerProcedure implements the same
+contract in Python so the pipeline can be exercised and benchmarked
+without a warehouse.
+"""
+import json
+from retrieval import RetrievalResult
+
+PROCEDURE_NAME = "CHATDOC_ANSWER"
+CONTEXT_PLACEHOLDER = "{{CONTEXT}}"  # Replaced by the rendered search results inside the procedure
+HISTORY_PLACEHOLDER = "{{HISTORY}}"  # Replaced by the chat history read inside the procedure
+SUGGESTION_SCAN_LIMIT = 50  # Chunks scanned for suggested questions, as in get_suggested_questions_from_kb
+
+# Arguments: question, category, model_name, prompt_template, num_chunks,
+#            user_id, org_id, suggested_questions (JSON), scan_suggestions,
+#            history_header, history_turns
+# Returns:   {"answer": str, "sources": [relative_path], "suggestion_chunks": [chunk], "history_stored": bool}
+# Failures reading or writing chat history, or scanning suggestions, are caught inside the
+# procedure so that an answer already produced by COMPLETE is always returned.
+PROCEDURE_SQL = r"""
+CREATE OR REPLACE PROCEDURE __DATABASE__.__SCHEMA__.__PROCEDURE__(
+    question STRING, category STRING, model_name STRING, prompt_template STRING, num_chunks NUMBER,
+    user_id STRING, org_id STRING, suggested_questions STRING, scan_suggestions BOOLEAN,
+    history_header STRING, history_turns NUMBER)
+RETURNS VARIANT
+LANGUAGE SQL
+EXECUTE AS CALLER
+AS
+$$
+DECLARE
+    search_request STRING;
+    search_results VARIANT;
+    context_text STRING DEFAULT '';
+    history_text STRING DEFAULT '';
+    sources ARRAY DEFAULT ARRAY_CONSTRUCT();
+    answer STRING;
+    suggestion_chunks ARRAY DEFAULT ARRAY_CONSTRUCT();
+    history_stored BOOLEAN DEFAULT FALSE;
+BEGIN
+    search_request := TO_JSON(OBJECT_CONSTRUCT(
+        'query', question,
+        'columns', ARRAY_CONSTRUCT('chunk', 'relative_path', 'category'),
+        'limit', num_chunks,
+        'filter', IFF(category = 'ALL', NULL, OBJECT_CONSTRUCT('@eq', OBJECT_CONSTRUCT('category', category)))
+    ));
+
+    -- SEARCH_PREVIEW only accepts constant arguments, so the request is inlined as an escaped literal
+    EXECUTE IMMEDIATE 'SELECT SNOWFLAKE.CORTEX.SEARCH_PREVIEW(''__DATABASE__.__SCHEMA__.__SERVICE__'', ''' ||
+        REPLACE(REPLACE(search_request, '\\', '\\\\'), '''', '\\''') || ''')';
+    SELECT PARSE_JSON($1):results INTO :search_results FROM TABLE(RESULT_SCAN(LAST_QUERY_ID()));
+
+    -- Rendered the same way as RetrievalResult.context_text()
+    SELECT COALESCE(LISTAGG('Source: ' || r.value:relative_path::STRING || ' (Category: ' || r.value:category::STRING || ')\n' || r.value:chunk::STRING, '\n\n')
+                        WITHIN GROUP (ORDER BY r.index), ''),
+           ARRAY_AGG(DISTINCT r.value:relative_path::STRING)
+      INTO :context_text, :sources
+      FROM TABLE(FLATTEN(INPUT => :search_results)) r;
+
+    -- Rendered the same way as DocumentAssistant.get_chat_history_context(), newest turn first
+    IF (user_id IS NOT NULL AND history_turns > 0) THEN
+        BEGIN
+            SELECT IFF(COUNT(*) = 0, '', :history_header ||
+                       LISTAGG('Q' || h.n || ': ' || h.question || '\nA' || h.n || ': ' || h.answer || '\n\n', '')
+                           WITHIN GROUP (ORDER BY h.n))
+              INTO :history_text
+              FROM (SELECT question, answer, ROW_NUMBER() OVER (ORDER BY timestamp DESC) AS n
+                    FROM __DATABASE__.__SCHEMA__.__HISTORY_TABLE__
+                    WHERE user_id = :user_id AND (NULLIF(:org_id, '') IS NULL OR org_id = :org_id)
+                    QUALIFY n <= :history_turns) h;
+        EXCEPTION
+            -- Like the client path, a missing history table only means no history in the prompt
+            WHEN OTHER THEN
+                history_text := '';
+        END;
+    END IF;
+
+    answer := SNOWFLAKE.CORTEX.COMPLETE(model_name, REPLACE(REPLACE(prompt_template,
+        '__HISTORY_PLACEHOLDER__', history_text), '__CONTEXT_PLACEHOLDER__', context_text));
+
+    -- Nothing after COMPLETE may fail the CALL, or the caller would have to answer again
+    IF (scan_suggestions) THEN
+        BEGIN
+            SELECT ARRAY_AGG(chunk) INTO :suggestion_chunks
+              FROM (SELECT chunk FROM __CHUNKS_TABLE__
+                    WHERE (:category = 'ALL' OR category = :category) AND CONTAINS(chunk, '?')
+                    LIMIT __SUGGESTION_SCAN_LIMIT__);
+        EXCEPTION
+            WHEN OTHER THEN
+                suggestion_chunks := ARRAY_CONSTRUCT();
+        END;
+    END IF;
+
+    IF (user_id IS NOT NULL) THEN
+        BEGIN
+            INSERT INTO __DATABASE__.__SCHEMA__.__HISTORY_TABLE__
+                (user_id, org_id, question, answer, model_name, category, related_documents, suggested_questions)
+                SELECT :user_id, :org_id, :question, :answer, :model_name, :category, :sources, PARSE_JSON(:suggested_questions);
+            history_stored := TRUE;
+        EXCEPTION
+            WHEN OTHER THEN
+                history_stored := FALSE;
+        END;
+    END IF;
+
+    RETURN OBJECT_CONSTRUCT('answer', answer, 'sources', sources, 'suggestion_chunks', suggestion_chunks,
+                            'history_stored', history_stored);
+END;
+$$
+"""
+
+
+class SnowflakeAnswerProcedure:
+    """Installs and calls the answer procedure; each call is a single round trip"""
+
+    def __init__(self, session_provider, database, schema, search_service, history_table, chunks_table="docs_chunks_table"):
+        self.session_provider = session_provider
+        self.qualified_name = f"{database}.{schema}.{PROCEDURE_NAME}"
+        self.definition = (
+            PROCEDURE_SQL
+            .replace("__DATABASE__", database)
+            .replace("__SCHEMA__", schema)
+            .replace("__PROCEDURE__", PROCEDURE_NAME)
+            .replace("__SERVICE__", search_service)
+            .replace("__HISTORY_TABLE__", history_table)
+            .replace("__CHUNKS_TABLE__", chunks_table)
+            .replace("__SUGGESTION_SCAN_LIMIT__", str(SUGGESTION_SCAN_LIMIT))
+            .replace("__CONTEXT_PLACEHOLDER__", CONTEXT_PLACEHOLDER)
+            .replace("__HISTORY_PLACEHOLDER__", HISTORY_PLACEHOLDER)
+        )
+        self.installed = False
+
+    def install(self):
+        """Create or replace the procedure; done once, outside the request path where possible"""
+        self.session_provider().sql(self.definition).collect()
+        self.installed = True
+
+    def __call__(self, question, category, model_name, prompt_template, num_chunks,
+                 user_id=None, org_id=None, suggested_questions=None, scan_suggestions=False,
+                 history_header="", history_turns=0):
+        if not self.installed:
+            self.install()
+        rows = self.session_provider().sql(
+            f"CALL {self.qualified_name}(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            params=[question, category, model_name, prompt_template, num_chunks,
+                    user_id, org_id, json.dumps(suggested_questions or []), scan_suggestions,
+                    history_header, history_turns]
+        ).collect()
+        result = rows[0][0]
+        return json.loads(result) if isinstance(result, str) else result
+
+
+class LocalAnswerProcedure:
+    """
+    In-process stand-in with the same contract as the Snowflake procedure.
+
+    search(query, category, limit) returns Cortex Search result rows,
+    complete(model_name, prompt) returns the completion text, kb_chunks is
+    the list of chunk texts scanned for suggested questions, and history_rows
+    holds the chat history rows (oldest first) that are read and appended to,
+    or is None to behave as if the history table did not exist.
+    """
+
+    def __init__(self, search, complete, kb_chunks=None, history_rows=()):
+        self.search = search
+        self.complete = complete
+        self.kb_chunks = kb_chunks or []
+        self.history_rows = list(history_rows) if history_rows is not None else None
+
+    def __call__(self, question, category, model_name, prompt_template, num_chunks,
+                 user_id=None, org_id=None, suggested_questions=None, scan_suggestions=False,
+                 history_header="", history_turns=0):
+        retrieval = RetrievalResult.from_rows(self.search(question, category, num_chunks))
+        sources = sorted(retrieval.relative_paths)
+
+        history_text = ""
+        if user_id is not None and history_turns > 0 and self.history_rows is not None:
+            turns = [
+                row for row in reversed(self.history_rows)
+                if row["user_id"] == user_id and (not org_id or row["org_id"] == org_id)
+            ][:history_turns]
+            if turns:
+                history_text = history_header + "".join(
+                    f"Q{idx}: {row['question']}\nA{idx}: {row['answer']}\n\n" for idx, row in enumerate(turns, 1)
+                )
+        prompt = prompt_template.replace(HISTORY_PLACEHOLDER, history_text).replace(CONTEXT_PLACEHOLDER, retrieval.context_text())
+        answer = self.complete(model_name, prompt)
+
+        suggestion_chunks = []
+        if scan_suggestions:
+            suggestion_chunks = [chunk for chunk in self.kb_chunks if "?" in chunk][:SUGGESTION_SCAN_LIMIT]
+
+        history_stored = False
+        if user_id is not None and self.history_rows is not None:
+            history_stored = True
+            self.history_rows.append({
+                "user_id": user_id,
+                "org_id": org_id,
+                "question": question,
+                "answer": answer,
+                "model_name": model_name,
+                "category": category,
+                "related_documents": sources,
+                "suggested_questions": suggested_questions or []
+            })
+
+        return {"answer": answer, "sources": sources, "suggestion_chunks": suggestion_chunks, "history_stored": history_stored}
@@ -0,0 +1,208 @@
+import os
+import re
+import time
+import hashlib
+import threading
+import logging
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Default configuration values
+ROUND_TRIP_BUDGET = int(os.environ.get("SQL_ROUND_TRIP_BUDGET", 6))  # Round trips allowed per request before flagging
+RECENT_PROFILES = int(os.environ.get("SQL_PROFILER_RECENT", 100))  # Request profiles kept for the debug endpoint
+QUERY_TAG_PREFIX = os.environ.get("SQL_QUERY_TAG_PREFIX", "chatdoc")  # Prefix of the Snowflake QUERY_TAG
+
+_COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+_current_profile = ContextVar("sql_request_profile", default=None)
+
+
+def fingerprint(sql):
+    """Normalize a statement by stripping comments and literals; returns (id, normalized text)"""
+    normalized = _COMMENTS.sub(" ", sql)
+    normalized = _STRINGS.sub("?", normalized)
+    normalized = _NUMBERS.sub("?", normalized)
+    normalized = _WHITESPACE.sub(" ", normalized).strip()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:12], normalized
+
+
+class RequestProfile:
+    """Round trips issued while serving a single request"""
+
+    def __init__(self, request_id, endpoint=None):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.query_tag = f"{QUERY_TAG_PREFIX}:{request_id}"
+        self.started = time.monotonic()
+        self.duration_ms = None
+        self.statements = []
+
+    @property
+    def over_budget(self):
+        return len(self.statements) > ROUND_TRIP_BUDGET
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "query_tag": self.query_tag,
+            "round_trips": len(self.statements),
+            "budget": ROUND_TRIP_BUDGET,
+            "over_budget": self.over_budget,
+            "duration_ms": self.duration_ms,
+            "sql_ms": round(sum(s["duration_ms"] for s in self.statements), 2),
+            "statements": list(self.statements)
+        }
+
+
+class SqlProfiler:
+    """Collects per-request and per-fingerprint statistics for Snowflake round trips"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=RECENT_PROFILES)
+        self._by_fingerprint = defaultdict(lambda: {"statement": None, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0, "errors": 0})
+        self._requests = 0
+        self._over_budget = 0
+
+    def start_request(self, request_id, endpoint=None):
+        profile = RequestProfile(request_id, endpoint)
+        _current_profile.set(profile)
+        return profile
+
+    def end_request(self):
+        """Finish the active request profile, log it, and flag it if it exceeded the budget"""
+        profile = _current_profile.get()
+        if profile is None:
+            return None
+        _current_profile.set(None)
+        profile.duration_ms = round((time.monotonic() - profile.started) * 1000, 2)
+        with self._lock:
+            self._requests += 1
+            if profile.over_budget:
+                self._over_budget += 1
+            self._recent.append(profile.to_dict())
+
+        summary = f"request {profile.request_id} {profile.endpoint}: {len(profile.statements)} round trips, {profile.duration_ms} ms"
+        if profile.over_budget:
+            fingerprints = ", ".join(s["fingerprint"] for s in profile.statements)
+            logging.warning(f"SQL round-trip budget ({ROUND_TRIP_BUDGET}) exceeded by {summary} [{fingerprints}]")
+        elif profile.statements:
+            logging.info(f"SQL profile for {summary}")
+        return profile
+
+    def current_query_tag(self):
+        profile = _current_profile.get()
+        return profile.query_tag if profile else None
+
+    def record(self, statement, duration_ms, rows=None, error=None):
+        """Record one round trip against the active request and the global fingerprint totals"""
+        fp_id, normalized = fingerprint(statement)
+        duration_ms = round(duration_ms, 2)
+        with self._lock:
+            stats = self._by_fingerprint[fp_id]
+            stats["statement"] = normalized
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["rows"] += rows or 0
+            if error:
+                stats["errors"] += 1
+
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.statements.append({
+                "fingerprint": fp_id,
+                "statement": normalized[:200],
+                "duration_ms": duration_ms,
+                "rows": rows,
+                "error": error
+            })
+
+    @contextmanager
+    def track(self, label):
+        """Time a non-SQL round trip (e.g. a Cortex Search REST call) under a fixed label"""
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(label, (time.monotonic() - start) * 1000, error=error)
+
+    def get_stats(self):
+        with self._lock:
+            fingerprints = sorted(
+                ({"fingerprint": fp_id, **stats, "total_ms": round(stats["total_ms"], 2)} for fp_id, stats in self._by_fingerprint.items()),
+                key=lambda item: item["total_ms"],
+                reverse=True
+            )
+            return {
+                "requests": self._requests,
+                "over_budget": self._over_budget,
+                "budget": ROUND_TRIP_BUDGET,
+                "fingerprints": fingerprints,
+                "recent": list(self._recent)
+            }
+
+
+class ProfiledDataFrame:
+    """Wraps a lazy Snowpark DataFrame so that execution is timed and tagged"""
+
+    def __init__(self, df, statement, profiler):
+        self._df = df
+        self._statement = statement
+        self._profiler = profiler
+
+    def _execute(self, action, rows_of, **kwargs):
+        query_tag = self._profiler.current_query_tag()
+        if query_tag:
+            # Per-statement QUERY_TAG avoids an extra ALTER SESSION round trip
+            statement_params = dict(kwargs.pop("statement_params", None) or {})
+            statement_params.setdefault("QUERY_TAG", query_tag)
+            kwargs["statement_params"] = statement_params
+        start = time.monotonic()
+        try:
+            result = getattr(self._df, action)(**kwargs)
+        except Exception as e:
+            self._profiler.record(self._statement, (time.monotonic() - start) * 1000, error=type(e).__name__)
+            raise
+        self._profiler.record(self._statement, (time.monotonic() - start) * 1000, rows=rows_of(result))
+        return result
+
+    def collect(self, **kwargs):
+        return self._execute("collect", len, **kwargs)
+
+    def to_pandas(self, **kwargs):
+        return self._execute("to_pandas", len, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._df, name)
+
+
+class ProfiledSession:
+    """Session proxy whose sql() statements are fingerprinted and timed on execution"""
+
+    def __init__(self, session, profiler):
+        self._session = session
+        self._profiler = profiler
+
+    @property
+    def raw(self):
+        return self._session
+
+    def sql(self, query, params=None):
+        return ProfiledDataFrame(self._session.sql(query, params=params), query, self._profiler)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+# Process-wide profiler shared by the assistant and the Flask request hooks
+profiler = SqlProfiler()
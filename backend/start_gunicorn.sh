@@ -11,5 +11,5 @@ fi
 # Activate the virtual environment (assuming venv is in the backend directory)
 source venv/bin/activate
 
-# Start Gunicorn
-exec venv/bin/gunicorn --workers 3 --bind 0.0.0.0:8000 --timeout 300  main:app
+# Start Gunicorn in pre-fork mode (workers, threads and shared cache are set in gunicorn.conf.py)
+exec venv/bin/gunicorn -c gunicorn.conf.py main:app